@@ -0,0 +1,386 @@
+# Author: Peter Jensen
+#
+# Decoder benchmark and golden output regression check
+#
+# Usage: decode.py [-?][-r n][-s][-u][-k name][-o file]
+#
+# Runs the wav -> cas decoding and the cas -> nas, nas -> cas, cas -> asm and
+# asm -> cas conversions on the recordings and examples in the repo, and on
+# longer synthetic tapes made by repeating a recording.  The .nas codec is run on a
+# 64KB memory image.  The cas -> wav encoder is
+# run on an example and on a 32KB image, which is also decoded after
+# simulating tape speed drift.  Reports the time spent in
+# each decoding stage, the throughput in seconds of audio per second, and
+# the peak memory use.  The output of every case is compared with the
+# checksums in golden.json, as are the repaired blocks of the block repair.
+# The parallel decoding must be faster than the serial decoding of the same
+# tape, given a CPU per process
+#
+import sys
+import os
+import io
+import json
+import time
+import wave
+import hashlib
+import tempfile
+import tracemalloc
+import contextlib
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+repoDir  = os.path.dirname(benchDir)
+sys.path.insert(0, repoDir)
+
+import numpy as np
+import wavcas
+import nascas
+import casasm
+import caswav
+
+goldenFilename = os.path.join(benchDir, 'golden.json')
+
+# Decoder counters checked against golden.json as well, for the cases that
+# return them
+goldenCounters = ['repairedBlocks', 'damagedBlocks']
+
+# Cases decoding with -j, the serial case decoding the same tape, and the
+# number of processes.  The parallel case must be faster than the serial one
+# when there are at least that many CPUs
+parallelCases = [('synthetic-x10-j4', 'synthetic-x10', 4)]
+
+class Params:
+  def __init__(self):
+    self.repeats   = 3
+    self.synthetic = True
+    self.update    = False
+    self.cases     = []
+    self.jsonFile  = None
+
+  @staticmethod
+  def paramError(msg = ''):
+    if msg != '':
+      print("ERROR: " + msg)
+    print("Usage: " + sys.argv[0] + " [-?][-r n][-s][-u][-k name][-o file]")
+    sys.exit(1)
+
+  def parse(self, argv = None):
+    if argv == None:
+      argv = sys.argv
+    pi = 1
+    while pi < len(argv):
+      arg = argv[pi]
+      if arg == '-?':
+        print(
+'''Benchmarks the conversions and checks their output against golden.json.
+
+  -?       Prints this information
+  -r n     Number of timed runs per case.  The fastest is reported. Default: 3
+  -s       Skips the synthetic long tapes
+  -u       Updates golden.json with the output of this run
+  -k name  Only runs the case with this name.  Can be repeated
+  -o file  Writes the results as JSON to file
+''')
+        sys.exit(0)
+      elif arg == '-s':
+        self.synthetic = False
+      elif arg == '-u':
+        self.update = True
+      elif arg in ['-r', '-k', '-o']:
+        pi += 1
+        if pi >= len(argv):
+          self.paramError(arg + ' must be followed by a value')
+        if arg == '-r':
+          self.repeats = wavcas.Params.toInt(argv[pi])
+          if self.repeats == None or self.repeats < 1:
+            self.paramError("Illegal value for -r parameter")
+        elif arg == '-k':
+          self.cases.append(argv[pi])
+        else:
+          self.jsonFile = argv[pi]
+      else:
+        self.paramError("Unexpected parameter: " + arg)
+      pi += 1
+    return self
+
+# Writes a recording repeated 'count' times to a temporary .wav file
+def syntheticTape(filename, count, tempDir):
+  with wave.open(filename, 'rb') as wf:
+    wfParams = wf.getparams()
+    frames = wf.readframes(wfParams.nframes)
+  name = os.path.join(tempDir, f'{os.path.splitext(os.path.basename(filename))[0]}-x{count}.wav')
+  with wave.open(name, 'wb') as wf:
+    wf.setparams(wfParams)
+    for _ in range(count):
+      wf.writeframes(frames)
+  return name
+
+def wavParams(filename, options):
+  params = wavcas.Params().parse(['wavcas.py'] + options + [filename, os.devnull])
+  params.silent = True
+  return params
+
+# The stage times are the ones collected by the decoder in its DecodeStats
+def decodeWav(filename, options):
+  params = wavParams(filename, options)
+  if params.chunkFrames != None:
+    sd = wavcas.StreamDecoder(wavcas.WavStream(filename, params), params)
+    output = b''.join(sd.process())
+    return output, sd.stats.stages, sd.stats.counters['audioSeconds']
+  wd = wavcas.convert(params)
+  return bytes(wd.allBytes), wd.stats.stages, wd.stats.counters['audioSeconds']
+
+# Decodes with the repair of the blocks with checksum errors (-b).  The
+# counters of the repaired and damaged blocks are returned as well
+def repairWav(filename, options):
+  wd = wavcas.convert(wavParams(filename, ['-b'] + options))
+  return bytes(wd.allBytes), wd.stats.stages, wd.stats.counters['audioSeconds'], wd.stats.counters
+
+# The bit confidences of a decoding, read back from the cache when cacheDir
+# is given.  The decoding is cached first, so the timed run is a cache hit
+def decodeConfidences(filename, options, cacheDir = None):
+  if cacheDir != None:
+    options = options + ['-d', cacheDir]
+    wavcas.convert(wavParams(filename, options))
+  wd = wavcas.convert(wavParams(filename, options))
+  rows, _ = wd.confidences()
+  return rows.tobytes(), wd.stats.stages, wd.stats.counters['audioSeconds']
+
+def casToNas(filename, tempDir):
+  nasFilename = os.path.join(tempDir, 'output.nas')
+  inputData = nascas.InputData()
+  inputData.initWithCas(filename)
+  nascas.NasFile(inputData, nasFilename).write()
+  return open(nasFilename, 'rb').read(), {}, None
+
+def nasToCas(filename, tempDir):
+  casFilename = os.path.join(tempDir, 'output.cas')
+  inputData = nascas.InputData()
+  inputData.initWithNas(filename)
+  nascas.CasFile(inputData, casFilename).write()
+  return open(casFilename, 'rb').read(), {}, None
+
+def casToAsm(filename):
+  lines = casasm.decode(open(filename, 'rb').read())
+  return ''.join(l + '\n' for l in lines).encode('latin-1'), {}, None
+
+# Converts a NAP .cas file with a noise byte in front of it, as wavcas often
+# writes, and without the .cas extension, so casasm must find the NAP records
+def noisyCasToAsm(filename, tempDir):
+  noisyFilename = os.path.join(tempDir, 'noisy.bin')
+  asmFilename   = os.path.join(tempDir, 'noisy.asm')
+  with open(noisyFilename, 'wb') as noisyFile:
+    noisyFile.write(b'\x37\x00' + open(filename, 'rb').read())
+  casasm.convert(casasm.Params().parse(['casasm.py', noisyFilename, asmFilename]))
+  return open(asmFilename, 'rb').read(), {}, None
+
+def asmToCas(filename, title):
+  return casasm.textToCas(filename, title), {}, None
+
+# A 64KB memory image, as dumped from a Nascom
+def image64k():
+  inputData = nascas.InputData()
+  inputData.startAddress = 0x0000
+  inputData.data = bytearray(bytes(range(256))*256)
+  return inputData
+
+def encodeNas(inputData):
+  return nascas.NasFile.encode(inputData), {}, None
+
+def decodeNas(content):
+  inputData = nascas.InputData()
+  inputData.initWithNasData(content)
+  return bytes(inputData.data), {}, None
+
+# Writes a .cas file with a 32KB image to tempDir
+def casImage32k(tempDir):
+  name = os.path.join(tempDir, 'image-32k.cas')
+  inputData = nascas.InputData()
+  inputData.startAddress = 0x1000
+  inputData.data = bytearray(bytes(range(256))*128)
+  nascas.CasFile(inputData, name).write()
+  return name
+
+# Encodes a .cas file and resamples it as if played from a tape that speeds
+# up by 10% over the recording, with 3% wow on top
+def driftTape(casFilename, tempDir):
+  params = caswav.Params().parse(['caswav.py', '-d', '8', casFilename])
+  samples = caswav.KcsEncoder(params).encode(open(casFilename, 'rb').read()).astype(np.float64)
+  seconds = np.arange(len(samples))/params.frameRate
+  speed   = 1.0 + 0.10*seconds/seconds[-1] + 0.03*np.sin(2*np.pi*seconds/2.0)
+  source  = np.cumsum(speed)
+  source  = source[source < len(samples) - 1]
+  drifted = np.interp(source, np.arange(len(samples)), samples)
+  name = os.path.join(tempDir, 'drift.wav')
+  with wave.open(name, 'wb') as wf:
+    wf.setnchannels(1)
+    wf.setsampwidth(1)
+    wf.setframerate(params.frameRate)
+    wf.writeframes(np.rint(drifted).astype(np.uint8).tobytes())
+  return name
+
+def encodeWav(filename, options, tempDir):
+  wavFilename = os.path.join(tempDir, 'output.wav')
+  params = caswav.Params().parse(['caswav.py'] + options + [filename, wavFilename])
+  params.silent = True
+  caswav.convert(params)
+  with wave.open(wavFilename, 'rb') as wf:
+    audioSeconds = wf.getnframes()/wf.getframerate()
+  return open(wavFilename, 'rb').read(), {}, audioSeconds
+
+# Encodes a .cas file to audio and decodes it again.  The golden value is
+# the hash of the .cas file itself, so the bytes must come back unchanged
+def roundTrip(filename, tempDir):
+  encodeWav(filename, [], tempDir)
+  return decodeWav(os.path.join(tempDir, 'output.wav'), [])
+
+def benchmarkCases(params, tempDir):
+  maanelander = os.path.join(repoDir, 'BLS-maanelander.wav')
+  napRam      = os.path.join(repoDir, 'BLS-nap-ram-v22.wav')
+  skakurCode  = os.path.join(repoDir, 'examples', 'skakur-code.cas')
+  skakurNas   = os.path.join(repoDir, 'examples', 'skakur-code.nas')
+  skakur      = os.path.join(repoDir, 'examples', 'skakur.cas')
+  skakurAsm   = os.path.join(repoDir, 'examples', 'skakur.asm')
+  nas64k      = nascas.NasFile.encode(image64k())
+  cases = [
+    ('maanelander',          lambda: decodeWav(maanelander, [])),
+    ('maanelander-stream',   lambda: decodeWav(maanelander, ['-c', '65536'])),
+    ('maanelander-cached',   lambda: decodeWav(maanelander, ['-d', os.path.join(tempDir, 'cache')])),
+    ('maanelander-2stop',    lambda: decodeWav(maanelander, ['-t', '2'])),
+    ('nap-ram',              lambda: decodeWav(napRam, [])),
+    ('nap-ram-n3-o',         lambda: decodeWav(napRam, ['-n', '3', '-o'])),
+    ('nap-ram-n3-o-stream',  lambda: decodeWav(napRam, ['-n', '3', '-o', '-c', '65536'])),
+    ('maanelander-pll',      lambda: decodeWav(maanelander, ['-r', 'pll'])),
+    ('nap-ram-n3-o-pll',     lambda: decodeWav(napRam, ['-n', '3', '-o', '-r', 'pll'])),
+    ('pll-confidence',       lambda: decodeConfidences(maanelander, ['-r', 'pll'])),
+    ('pll-confidence-cached',
+     lambda: decodeConfidences(maanelander, ['-r', 'pll'], os.path.join(tempDir, 'cache'))),
+    ('nap-ram-repair',       lambda: repairWav(napRam, [])),
+    ('nap-ram-auto',         lambda: decodeWav(napRam, ['-a'])),
+    ('nap-ram-bandpass',     lambda: decodeWav(napRam, ['-k', 'bandpass', '-n', '71'])),
+    ('goertzel-n3',          lambda: decodeWav(napRam, ['-n', '3', '-e', 'goertzel'])),
+    ('goertzel-n3-stream',   lambda: decodeWav(napRam, ['-n', '3', '-e', 'goertzel', '-c', '65536'])),
+    ('skakur-code-cas-nas',  lambda: casToNas(skakurCode, tempDir)),
+    ('skakur-code-nas-cas',  lambda: nasToCas(skakurNas, tempDir)),
+    ('skakur-cas-asm',       lambda: casToAsm(skakur)),
+    ('skakur-noise-cas-asm', lambda: noisyCasToAsm(skakur, tempDir)),
+    ('skakur-asm-cas',       lambda: asmToCas(skakurAsm, 'Skakur Version 2.2')),
+    ('skakur-code-nas-wav',  lambda: encodeWav(skakurNas, [], tempDir)),
+    ('skakur-code-round-trip', lambda: roundTrip(skakurCode, tempDir)),
+    ('skakur-round-trip',    lambda: roundTrip(skakur, tempDir)),
+    ('nas-encode-64k',       lambda: encodeNas(image64k())),
+    ('nas-decode-64k',       lambda: decodeNas(nas64k)),
+  ]
+  if params.synthetic:
+    long  = syntheticTape(maanelander, 10, tempDir)
+    image = casImage32k(tempDir)
+    drift = driftTape(image, tempDir)
+    cases += [
+      ('synthetic-x10',        lambda: decodeWav(long, [])),
+      ('synthetic-x10-stream', lambda: decodeWav(long, ['-c', '65536'])),
+      ('synthetic-x10-j4',     lambda: decodeWav(long, ['-j', '4'])),
+      ('drift',                lambda: decodeWav(drift, [])),
+      ('drift-pll',            lambda: decodeWav(drift, ['-r', 'pll'])),
+      ('encode-32k',           lambda: encodeWav(image, [], tempDir)),
+      ('encode-32k-8bit',      lambda: encodeWav(image, ['-d', '8'], tempDir)),
+    ]
+  if len(params.cases) > 0:
+    cases = [c for c in cases if c[0] in params.cases]
+  return cases
+
+def runCase(run, repeats):
+  best = None
+  for _ in range(repeats):
+    with contextlib.redirect_stdout(io.StringIO()):
+      start = time.perf_counter()
+      output, stageTimes, audioSeconds, *counters = run()
+      seconds = time.perf_counter() - start
+    if best == None or seconds < best['seconds']:
+      best = {'seconds': seconds, 'stages': stageTimes, 'audioSeconds': audioSeconds}
+  best['counters'] = {name: value for name, value in (counters[0] if counters else {}).items()
+                      if name in goldenCounters}
+  # a separate run for the memory use, as tracing slows things down
+  tracemalloc.start()
+  with contextlib.redirect_stdout(io.StringIO()):
+    run()
+  best['peakMemory'] = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  best['sha256'] = hashlib.sha256(output).hexdigest()
+  best['size'] = len(output)
+  return best
+
+# The number of CPUs the benchmark can run on
+def availableCpus():
+  if hasattr(os, 'sched_getaffinity'):
+    return len(os.sched_getaffinity(0))
+  return os.cpu_count() or 1
+
+# Reports the speedup of the parallel cases over their serial cases.  Returns
+# the parallel cases that are slower than serial on enough CPUs
+def checkParallel(results):
+  slower = []
+  cpus = availableCpus()
+  for name, serialName, jobs in parallelCases:
+    if name not in results or serialName not in results:
+      continue
+    speedup = results[serialName]['seconds']/results[name]['seconds']
+    results[name]['speedup'] = speedup
+    line = f'{name}: {speedup:.2f}x the speed of {serialName}'
+    if cpus < jobs:
+      line += f' (not checked: needs {jobs} CPUs, has {cpus})'
+    elif speedup <= 1.0:
+      line += ' SLOWER THAN SERIAL'
+      slower.append(name)
+    print(line)
+  return slower
+
+def main():
+  params = Params().parse()
+  golden = {}
+  if os.path.exists(goldenFilename):
+    golden = json.load(open(goldenFilename))
+  results = {}
+  failed = []
+  with tempfile.TemporaryDirectory() as tempDir:
+    for name, run in benchmarkCases(params, tempDir):
+      result = runCase(run, params.repeats)
+      results[name] = result
+      if params.update:
+        golden[name] = {'sha256': result['sha256'], 'size': result['size'], **result['counters']}
+        status = 'updated'
+      elif name not in golden:
+        status = 'NO GOLDEN OUTPUT'
+        failed.append(name)
+      elif golden[name]['sha256'] != result['sha256']:
+        status = 'OUTPUT DIFFERS'
+        failed.append(name)
+      elif any(golden[name][counter] != result['counters'].get(counter)
+               for counter in goldenCounters if counter in golden[name]):
+        status = 'COUNTERS DIFFER'
+        failed.append(name)
+      else:
+        status = 'ok'
+      result['status'] = status
+      line = f'{name:22} {result["seconds"]*1000:9.1f}ms {result["peakMemory"]/2**20:8.1f}MB'
+      if result['audioSeconds'] != None:
+        line += f' {result["audioSeconds"]/result["seconds"]:7.1f}x realtime'
+      print(f'{line:62} {status}')
+      stageText = ', '.join(f'{stage}: {t*1000:.1f}ms' for stage, t in result['stages'].items() if t > 0)
+      if stageText != '':
+        print('    ' + stageText)
+  slower = checkParallel(results)
+  if params.update:
+    with open(goldenFilename, 'w') as goldenFile:
+      json.dump(golden, goldenFile, indent=2, sort_keys=True)
+      goldenFile.write('\n')
+  if params.jsonFile != None:
+    with open(params.jsonFile, 'w') as jsonFile:
+      json.dump(results, jsonFile, indent=2)
+  if len(failed) > 0:
+    print('Golden output check failed for: ' + ', '.join(failed))
+  if len(slower) > 0:
+    print('Parallel decoding is slower than serial for: ' + ', '.join(slower))
+  if len(failed) > 0 or len(slower) > 0:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
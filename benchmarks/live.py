@@ -0,0 +1,148 @@
+# Author: Peter Jensen
+#
+# Live decoding benchmark
+#
+# Usage: live.py [-?][-x n][-k name]
+#
+# Stands in for a tape player: streams the recordings in the repo through a
+# pipe to wavcas.py -l, paced as if they were played, n times faster than
+# real time.  Reports how long after the end of each NAS-SYS block was sent
+# the block was reported by the decoder, and checks the decoded output
+# against the checksums in golden.json
+#
+import sys
+import os
+import re
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import subprocess
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+repoDir  = os.path.dirname(benchDir)
+sys.path.insert(0, repoDir)
+
+import wavcas
+
+goldenFilename = os.path.join(benchDir, 'golden.json')
+packetSeconds  = 0.01  # audio sent at a time
+
+class Params:
+  def __init__(self):
+    self.speed = 1
+    self.cases = []
+
+  @staticmethod
+  def paramError(msg = ''):
+    if msg != '':
+      print("ERROR: " + msg)
+    print("Usage: " + sys.argv[0] + " [-?][-x n][-k name]")
+    sys.exit(1)
+
+  def parse(self, argv = None):
+    if argv == None:
+      argv = sys.argv
+    pi = 1
+    while pi < len(argv):
+      arg = argv[pi]
+      if arg == '-?':
+        print(
+'''Streams the recordings to wavcas.py -l and reports the block latencies.
+
+  -?       Prints this information
+  -x n     Plays the recordings n times faster than real time. Default: 1
+  -k name  Only runs the case with this name.  Can be repeated
+''')
+        sys.exit(0)
+      elif arg in ['-x', '-k']:
+        pi += 1
+        if pi >= len(argv):
+          self.paramError(arg + ' must be followed by a value')
+        if arg == '-x':
+          self.speed = wavcas.Params.toInt(argv[pi])
+          if self.speed == None or self.speed < 1:
+            self.paramError("Illegal value for -x parameter")
+        else:
+          self.cases.append(argv[pi])
+      else:
+        self.paramError("Unexpected parameter: " + arg)
+      pi += 1
+    return self
+
+# Collects the output lines of the decoder with the time they arrived
+def readLines(stream, lines):
+  for line in stream:
+    lines.append((time.perf_counter(), line.decode('latin-1').rstrip('\n')))
+
+# Plays filename to the decoder.  Returns the decoded bytes, the reported
+# blocks as (block end in seconds of audio, latency in seconds) and the
+# decoder output
+def play(filename, options, speed, tempDir):
+  outFilename = os.path.join(tempDir, 'live.cas')
+  with open(filename, 'rb') as wavFile:
+    header = wavcas.WavHeader(wavFile)
+    wavFile.seek(0)
+    content = wavFile.read(header.dataOffset + header.nFrames*header.blockAlign)
+  proc = subprocess.Popen([sys.executable, os.path.join(repoDir, 'wavcas.py'), '-l', '1'] + options +
+                          ['-', outFilename],
+                          stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+  lines  = []
+  reader = threading.Thread(target=readLines, args=(proc.stdout, lines), daemon=True)
+  reader.start()
+  packet = round(packetSeconds*header.frameRate)*header.blockAlign
+  bytesPerSecond = header.frameRate*header.blockAlign*speed
+  proc.stdin.write(content[0:header.dataOffset])
+  start = time.perf_counter()
+  for pos in range(header.dataOffset, len(content), packet):
+    delay = start + (pos - header.dataOffset)/bytesPerSecond - time.perf_counter()
+    if delay > 0:
+      time.sleep(delay)
+    proc.stdin.write(content[pos:pos+packet])
+    proc.stdin.flush()
+  proc.stdin.close()
+  proc.wait()
+  reader.join()
+  blocks = []
+  for arrival, line in lines:
+    match = re.search(r'Block [0-9A-F]{2} \(.*\) at ([0-9.]+)s', line)
+    if match != None:
+      blockEnd = float(match.group(1))
+      blocks.append((blockEnd, arrival - (start + blockEnd/speed)))
+  return open(outFilename, 'rb').read(), blocks, [l for _, l in lines]
+
+def main():
+  params = Params().parse()
+  golden = json.load(open(goldenFilename))
+  maanelander = os.path.join(repoDir, 'BLS-maanelander.wav')
+  napRam      = os.path.join(repoDir, 'BLS-nap-ram-v22.wav')
+  cases = [
+    ('maanelander',  maanelander, []),
+    ('nap-ram-n3-o', napRam,      ['-n', '3', '-o']),
+  ]
+  if len(params.cases) > 0:
+    cases = [c for c in cases if c[0] in params.cases]
+  failed = []
+  with tempfile.TemporaryDirectory() as tempDir:
+    for name, filename, options in cases:
+      output, blocks, lines = play(filename, options, params.speed, tempDir)
+      status = 'ok'
+      if hashlib.sha256(output).hexdigest() != golden[name]['sha256']:
+        status = 'OUTPUT DIFFERS'
+        failed.append(name)
+      if len(blocks) == 0:
+        status = 'NO BLOCKS REPORTED'
+        failed.append(name)
+        print(f'{name:16} {status}')
+        print('\n'.join('    ' + l for l in lines[-5:]))
+        continue
+      latencies = [latency for _, latency in blocks]
+      print(f'{name:16} {len(blocks):3} blocks, latency max: {max(latencies)*1000:6.1f}ms, ' +
+            f'mean: {sum(latencies)/len(latencies)*1000:6.1f}ms  {status}')
+  if len(failed) > 0:
+    print('Live decoding failed for: ' + ', '.join(failed))
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
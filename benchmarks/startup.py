@@ -0,0 +1,115 @@
+# Author: Peter Jensen
+#
+# Startup benchmark for the scripts
+#
+# Usage: startup.py [-?][-n runs][-v][-b script=ms]
+#
+# Measures the time it takes to start python and import each script, minus
+# the time it takes to start python alone.  Fails if a script exceeds its
+# startup budget
+#
+import sys
+import os
+import subprocess
+import statistics
+import time
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# startup budget in milliseconds on top of the interpreter startup
+budgets = {
+  'wavcas':   300,
+  'nascas':   50,
+  'casasm':   50,
+  'nasbatch': 350,
+  'caswav':   300,
+}
+
+class Params:
+  def __init__(self):
+    self.runs    = 10
+    self.verbose = False
+    self.budgets = dict(budgets)
+
+  @staticmethod
+  def paramError(msg = ''):
+    if msg != '':
+      print("ERROR: " + msg)
+    print("Usage: " + sys.argv[0] + " [-?][-n runs][-v][-b script=ms]")
+    sys.exit(1)
+
+  def parse(self, argv = None):
+    if argv == None:
+      argv = sys.argv
+    pi = 1
+    while pi < len(argv):
+      arg = argv[pi]
+      if arg == '-?':
+        print(
+'''Measures the import time of the scripts.
+
+  -?           Prints this information
+  -n runs      Number of runs per script.  The median is reported. Default: 10
+  -v           Lists the slowest imported modules of each script
+  -b script=ms Sets the startup budget of a script in milliseconds
+''')
+        sys.exit(0)
+      elif arg == '-v':
+        self.verbose = True
+      elif arg in ['-n', '-b']:
+        pi += 1
+        if pi >= len(argv):
+          self.paramError(arg + ' must be followed by a value')
+        if arg == '-n':
+          try:
+            self.runs = int(argv[pi])
+          except ValueError:
+            self.paramError("Illegal value for -n parameter")
+        else:
+          script, _, ms = argv[pi].partition('=')
+          if script not in self.budgets or not ms.isdigit():
+            self.paramError("Illegal value for -b parameter: " + argv[pi])
+          self.budgets[script] = int(ms)
+      else:
+        self.paramError("Unexpected parameter: " + arg)
+      pi += 1
+    return self
+
+def timeCommand(code, runs):
+  times = []
+  for _ in range(runs):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], cwd=repoDir, check=True)
+    times.append(time.perf_counter() - start)
+  return statistics.median(times)*1000
+
+# The slowest modules according to python -X importtime
+def slowestImports(script, count = 5):
+  result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + script],
+                          cwd=repoDir, capture_output=True, text=True, check=True)
+  imports = []
+  for line in result.stderr.splitlines():
+    fields = line.split('|')
+    if len(fields) == 3 and fields[1].strip().isdigit():
+      imports.append((int(fields[1]), fields[2].rstrip()))
+  return sorted(imports, reverse=True)[0:count]
+
+def main():
+  params = Params().parse()
+  baseline = timeCommand('pass', params.runs)
+  print(f'Interpreter startup: {baseline:.1f}ms')
+  failed = []
+  for script, budget in params.budgets.items():
+    importTime = timeCommand('import ' + script, params.runs) - baseline
+    status = 'ok' if importTime <= budget else 'OVER BUDGET'
+    print(f'{script + ".py":12} {importTime:7.1f}ms (budget: {budget}ms) {status}')
+    if importTime > budget:
+      failed.append(script)
+    if params.verbose:
+      for cumulative, module in slowestImports(script):
+        print(f'    {cumulative/1000:7.1f}ms {module}')
+  if len(failed) > 0:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -1,10 +1,23 @@
 # Author: Peter Jensen
 #
-# Convert a .cas file written with NAP to a text file
+# Convert a .cas file written with NAP to a text file, and a text file to a
+# .cas file that can be read with NAP
+#
+# Usage: casasm.py [-t title] <input file> [<output file>]
+#
+# An input file with the .cas extension, or with NAP records in it, is a NAP
+# .cas file, and the output is the source text.  Otherwise the input is the
+# source text and the output a NAP .cas file, with the title given by -t or
+# the name of the input file.  Use - as output file for standard out.  An
+# existing output file is only replaced by a complete output
 #
 import sys
 import os
 import re
+import mmap
+import itertools
+
+import nascas
 
 class Log:
   @staticmethod
@@ -17,50 +30,197 @@ class Log:
     sys.exit(1)
 
 class Params:
-  inputFilename  = None
-  outputFilename = None
+  def __init__(self):
+    self.inputFilename  = None
+    self.outputFilename = None
+    self.title          = None
 
   @staticmethod
   def paramError(msg = ''):
     if msg != '':
       Log.error(msg)
-    print("Usage: " + sys.argv[0] + " <input file> [<output file>]")
+    print("Usage: " + sys.argv[0] + " [-t title] <input file> [<output file>]")
     sys.exit(1)
 
-  @classmethod
-  def parse(cls):
-    for p in sys.argv[1:]:
-      if cls.inputFilename == None:
-        cls.inputFilename = p
-      elif cls.outputFilename == None:
-        cls.outputFilename = p
+  def parse(self, argv = None):
+    if argv == None:
+      argv = sys.argv
+    pi = 1
+    while pi < len(argv):
+      p = argv[pi]
+      if p == '-t':
+        pi += 1
+        if pi >= len(argv):
+          self.paramError('-t must be followed by a title')
+        self.title = argv[pi]
+      elif self.inputFilename == None:
+        self.inputFilename = p
+      elif self.outputFilename == None:
+        self.outputFilename = p
       else:
-        cls.paramError('Too many parameters')
-    if cls.inputFilename == None:
-      cls.paramError('Input file not specified')
-    if cls.outputFilename == None:
-      cls.outputFilename = os.path.splitext(os.path.basename(cls.inputFilename))[0] + '.asm'
+        self.paramError('Too many parameters')
+      pi += 1
+    if self.inputFilename == None:
+      self.paramError('Input file not specified')
+    return self
+
+# The layout of a .cas file written by NAP:
+#   10 zeros and FF FF FF FF
+#   a title record
+#   a record per source line, each after 6 zeros
+#   16 zeros, 1B 1B 1B and 2 zeros
+# A record is the text, 0D and a checksum, which is the sum of the text and
+# the 0D with the high bit set.  In the source lines, a run of n spaces is
+# compressed to the byte 0x80 + n - 1
+class NapFormat:
+  leader     = bytes(10) + bytes([0xff]*4)
+  gap        = bytes(6)
+  trailer    = bytes(16) + bytes([0x1b]*3) + bytes(2)
+  maxSpaces  = 0x7f  # compressed to 0xfe; 0xff is never used in a record
+  lineRe     = re.compile(b'\x00\x00\x00\x00\x00\x00([^\x00\xff]*)\x0d')
+  titleRe    = re.compile(b'\xff\xff\xff\xff([^\x00\xff]*)\x0d')
+  plainBytes = bytes(range(0x80))
+  batchLines = 4096  # lines expanded at a time
+
+# True if content has a record of a .cas file written by NAP.  The records
+# are found anywhere, as a tape often starts with a few noise bytes
+def isNapCas(content):
+  return NapFormat.lineRe.search(content) != None
+
+# The title record of a .cas file written by NAP, or None if there is none
+def title(content):
+  match = NapFormat.titleRe.search(content)
+  return None if match == None else match.group(1).decode('latin-1')
+
+# The source text in the content of a .cas file written by NAP, as chunks of
+# whole lines.  The records are found lazily, and a batch of them is expanded
+# with a replace per compressed run length in it.  content can also be an
+# mmap of the file
+def textChunks(content):
+  records = (match.group(1) for match in NapFormat.lineRe.finditer(content))
+  while True:
+    batch = list(itertools.islice(records, NapFormat.batchLines))
+    if len(batch) == 0:
+      return
+    text = b'\n'.join(batch) + b'\n'
+    for b in set(text.translate(None, NapFormat.plainBytes)):
+      text = text.replace(bytes([b]), b' '*(b - 0x80 + 1))
+    yield text.decode('latin-1')
+
+# The source lines, one at a time
+def lines(content):
+  for chunk in textChunks(content):
+    yield from chunk.split('\n')[:-1]
+
+def decode(inputData):
+  return list(lines(inputData))
+
+# Compresses the runs of spaces in text, the longest runs first
+def compressSpaces(text):
+  longest = 0
+  while longest < NapFormat.maxSpaces and b' '*(longest + 1) in text:
+    longest += 1
+  for n in range(longest, 0, -1):
+    text = text.replace(b' '*n, bytes([0x80 + n - 1]))
+  return text
+
+def record(text):
+  text += b'\x0d'
+  return text + bytes([(sum(text) & 0xff) | 0x80])
+
+# The end of a record by the sum of its text
+recordTails = [bytes([0x0d, ((s + 0x0d) & 0xff) | 0x80]) for s in range(256)]
+
+# The content of a NAP .cas file with the source lines.  Raises
+# nascas.NasError for characters that NAP can't store
+def encode(sourceLines, title = ''):
+  sourceLines = list(sourceLines)
+  text = '\n'.join(sourceLines)
+  if not text.isascii() or '\x00' in text or '\x0d' in text:
+    for num, line in enumerate(sourceLines):
+      if not line.isascii() or '\x00' in line or '\x0d' in line:
+        nascas.error(f'Line {num + 1} has characters that NAP cannot store: {line!r}')
+  enc = [NapFormat.leader, record(title.encode('latin-1'))]
+  if len(sourceLines) > 0:
+    # the gap, the text and a tail of 0D and the checksum for each line
+    texts = compressSpaces(text.encode('latin-1')).split(b'\n')
+    tails = [recordTails[s & 0xff] for s in map(sum, texts)]
+    enc.extend(itertools.chain.from_iterable(zip(itertools.repeat(NapFormat.gap), texts, tails)))
+  enc.append(NapFormat.trailer)
+  return b''.join(enc)
+
+# Library API: the source text of a .cas file written by NAP.  source is a file
+# name, a binary file object or a buffer.  Raises nascas.NasError if the
+# file can't be read
+def casToText(source):
+  return ''.join(textChunks(nascas.readSource(source)))
+
+# Library API: a NAP .cas file with the source text, read from a file name, a
+# binary file object or a buffer.  title is the title record, which isn't
+# part of the text
+def textToCas(source, title = ''):
+  text = bytes(nascas.readSource(source)).decode('latin-1').replace('\r\n', '\n')
+  if text.endswith('\n'):
+    text = text[:-1]
+  return encode(text.split('\n'), title)
+
+# Writes the chunks to the output file.  The file is written under a
+# temporary name and renamed when complete, so an existing file isn't
+# truncated if the conversion fails
+def writeOutput(filename, mode, chunks):
+  if filename == '-':
+    with open(sys.stdout.fileno(), mode, closefd=False) as outputFile:
+      outputFile.writelines(chunks)
+    return
+  tempFilename = filename + '.tmp'
+  try:
+    with open(tempFilename, mode) as outputFile:
+      outputFile.writelines(chunks)
+    os.replace(tempFilename, filename)
+  except OSError:
+    Log.errorExit("Cannot write to output file: " + filename)
+  finally:
+    if os.path.exists(tempFilename):
+      os.remove(tempFilename)
+
+# The input file, mapped into memory
+def mapInput(filename):
+  try:
+    with open(filename, 'rb') as file:
+      return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+  except ValueError:
+    return b''  # an empty file
+  except OSError:
+    nascas.error("Cannot open input file: " + filename)
+
+# The output file defaults to the name of the input file, with .asm for a
+# NAP .cas input and .cas for a text input.  The title of a NAP .cas input is
+# printed, as it isn't part of the text
+def convert(params):
+  content = mapInput(params.inputFilename)
+  name, ext = os.path.splitext(os.path.basename(params.inputFilename))
+  toText = ext.lower() == '.cas' or isNapCas(content)
+  outputFilename = params.outputFilename
+  if outputFilename == None:
+    outputFilename = name + ('.asm' if toText else '.cas')
+  if toText:
+    if outputFilename != '-':
+      print("Converting NAP CAS to text: " + outputFilename)
+      casTitle = title(content)
+      if casTitle != None:
+        print("Title: " + casTitle)
+    writeOutput(outputFilename, 'w', textChunks(content))
+  else:
+    if outputFilename != '-':
+      print("Converting text to NAP CAS: " + outputFilename)
+    writeOutput(outputFilename, 'wb', [textToCas(content, name if params.title == None else params.title)])
 
-class Lines:
-  def __init__(self):
-    self.lines = None
-
-def toString(bytes):
-  s = ''
-  for b in bytes:
-    if b >= 0x80:
-      spaces = b - 0x80 + 1
-      s += ' '*spaces
-    else:
-      s += chr(b)
-  return s
-  
 def main():
-  Params.parse()
-  inputData = open(Params.inputFilename, "rb").read()
-  lines = re.findall(b'\x00\x00\x00\x00\x00\x00([^\x00\xff]*)\x0d', inputData)
-  for l in lines:
-    print(toString(l))  
+  params = Params().parse()
+  try:
+    convert(params)
+  except nascas.NasError as nasError:
+    Log.errorExit(nasError.args[0])
 
 if __name__ == '__main__':
   main()
@@ -0,0 +1,257 @@
+# Author: Peter Jensen
+#
+# Convert .cas (or .nas) to .wav
+#
+# Usage: caswav.py <input-file> <output-file>
+#
+# The reverse of wavcas.py.  The bytes of the .cas file are encoded with the
+# Kansas City Standard, so they can be loaded from tape by a Nascom, or used
+# to test the decoder.  A .nas file is converted to the .cas format first.
+# Any file with the .cas extension is encoded as is, e.g. the NAP source
+# files written by casasm.py.
+#  0: 1200Hz
+#  1: 2400Hz
+#  A byte is encoded as (18N1):
+#    0:     start-bit
+#    d0-d7: data bits
+#    1:     stop-bit(s)
+#  At 1200 baud a bit is 1 cycle of 1200Hz or 2 cycles of 2400Hz, at 300
+#  baud it is 4 or 8 cycles
+#
+import sys
+import os
+import wave
+import numpy as np
+
+import nascas
+
+class Config:
+  zeroFreq  = 1200  # frequency of 0-bit
+  oneFreq   = 2400  # frequency of 1-bit
+  bauds     = [300, 600, 1200]
+  bitDepths = [8, 16, 24, 32]
+  minFrameRate = 8000
+  leadOut   = 0.5   # seconds of 1-bits after the data
+  endBits   = [1, 0] # ends the last byte with a start bit, as the decoder
+                     # decodes the bits between start bits.  A UART reads
+                     # it as an extra 0xFF byte after the data
+  chunkBits = 65536 # bits synthesized at a time, to bound the memory use
+
+# Options for one conversion
+class Params:
+  def __init__(self):
+    self.inputFilename  = None
+    self.outputFilename = None
+    self.silent         = False
+    self.baud           = 1200
+    self.stopBits       = 1
+    self.frameRate      = 44100
+    self.bitDepth       = 16
+    self.amplitude      = 50    # percent of full scale
+    self.leadIn         = 1000  # milliseconds of 1-bits before the data
+
+  @staticmethod
+  def usage():
+    print(
+'''Converts a .cas (or .nas) file to a .wav file with the Kansas City Standard
+encoding of 18N1 (one '0' start bit, 8 data bits, and one '1' stop bit).
+The bytes of any .cas file are encoded as they are, e.g. NAP source files.
+
+Invocation:
+  caswav.py [-?][-s][-b n][-t n][-r n][-d n][-a n][-l n] <input file> <output file>
+
+where:
+  -?    Prints this information
+  -s    Turns on silent mode
+  -b n  Baud rate: 300, 600 or 1200. Default: 1200
+  -t n  Number of stop bits (1 or 2). Default: 1
+  -r n  Frame rate (Hz). Default: 44100
+  -d n  Bits per sample: 8, 16, 24 or 32. Default: 16
+  -a n  Amplitude in percent of full scale. Default: 50
+  -l n  Lead-in: milliseconds of 2400Hz tone before the data. Default: 1000
+''')
+
+  @staticmethod
+  def paramError(msg = ''):
+    if msg != '':
+      print("ERROR: " + msg)
+    print("Usage: " + sys.argv[0] + " [-?][-s][-b n][-t n][-r n][-d n][-a n][-l n] <input file> <output file>")
+    print("Use -? to see detailed usage information")
+    sys.exit(1)
+
+  @staticmethod
+  def toInt(s):
+    try:
+      if s[0:2] == '0x':
+        return int(s[2:], 16)
+      else:
+        return int(s)
+    except:
+      return None
+
+  def parse(self, argv = None):
+    if argv == None:
+      argv = sys.argv
+    pi = 1
+    while pi < len(argv):
+      arg = argv[pi]
+      if arg == '-?':
+        self.usage()
+        sys.exit(0)
+      elif arg == '-s':
+        self.silent = True
+      elif arg in ['-b', '-t', '-r', '-d', '-a', '-l']:
+        pi += 1
+        if pi >= len(argv):
+          self.paramError(arg + ' must be followed by a number')
+        value = self.toInt(argv[pi])
+        if value == None:
+          self.paramError("Illegal number syntax for " + arg + " parameter")
+        if arg == '-b':
+          if value not in Config.bauds:
+            self.paramError("Illegal value for -b parameter.  Must be one of: " +
+                            ', '.join(str(b) for b in Config.bauds))
+          self.baud = value
+        elif arg == '-t':
+          if value not in [1, 2]:
+            self.paramError("Illegal value for -t parameter.  Must be 1 or 2")
+          self.stopBits = value
+        elif arg == '-r':
+          if value < Config.minFrameRate:
+            self.paramError(f"Frame rate must be at least {Config.minFrameRate}")
+          self.frameRate = value
+        elif arg == '-d':
+          if value not in Config.bitDepths:
+            self.paramError("Illegal value for -d parameter.  Must be 8, 16, 24 or 32")
+          self.bitDepth = value
+        elif arg == '-a':
+          if value < 1 or value > 100:
+            self.paramError("Illegal value for -a parameter.  Must be 1..100")
+          self.amplitude = value
+        else:
+          if value < 0:
+            self.paramError("Illegal value for -l parameter")
+          self.leadIn = value
+      else:
+        if self.inputFilename == None:
+          self.inputFilename = arg
+        elif self.outputFilename == None:
+          self.outputFilename = arg
+        else:
+          self.paramError("Only two parameters allowed")
+      pi += 1
+    if self.inputFilename == None:
+      self.paramError("Input file not specified")
+    if self.outputFilename == None:
+      self.outputFilename = os.path.splitext(os.path.basename(self.inputFilename))[0] + '.wav'
+    return self
+
+# Synthesizes the audio for a string of bytes.  Every bit is a whole number of
+# cycles, so the waveform of a bit only depends on its value and its length
+# in frames, which is one of two lengths when the frame rate isn't a multiple
+# of the baud rate.  The waveforms are computed once for each value and
+# length, and the frames are looked up from them a chunk of bits at a time
+class KcsEncoder:
+  def __init__(self, params):
+    self.params       = params
+    self.framesPerBit = params.frameRate/params.baud
+
+  # The bits of the bytes, including start and stop bits, in the order sent
+  def frameBits(self, data):
+    byteVals = np.frombuffer(bytes(data), dtype=np.uint8)
+    dataBits = np.unpackbits(byteVals[:, None], axis=1, bitorder='little')
+    startBit = np.zeros((len(byteVals), 1), dtype=np.uint8)
+    stopBits = np.ones((len(byteVals), self.params.stopBits), dtype=np.uint8)
+    return np.hstack((startBit, dataBits, stopBits)).ravel()
+
+  # Sample values in the output format for scaled values in -1..1
+  def _quantize(self, values):
+    scale = self.params.amplitude/100
+    if self.params.bitDepth == 8:
+      return (0x80 + np.rint(values*scale*0x7f)).astype(np.uint8)
+    maxValue = (1 << (self.params.bitDepth - 1)) - 1
+    dtype = np.int16 if self.params.bitDepth == 16 else np.int32
+    return np.rint(values*scale*maxValue).astype(dtype)
+
+  # The waveform of a bit.  Sampled in the middle of the frames, so there
+  # are no samples right on the zero crossings
+  def _bitWaveform(self, bit, length):
+    cycles = (Config.oneFreq if bit == 1 else Config.zeroFreq)/self.params.baud
+    return np.sin(2*np.pi*cycles*(np.arange(length) + 0.5)/length)
+
+  # Samples for the bytes, with the lead-in and lead-out tones
+  def encode(self, data):
+    leadInBits  = round(self.params.leadIn/1000*self.params.baud)
+    leadOutBits = round(Config.leadOut*self.params.baud)
+    bits = np.concatenate((np.ones(leadInBits, dtype=np.uint8),
+                           self.frameBits(data),
+                           np.array(Config.endBits, dtype=np.uint8),
+                           np.ones(leadOutBits, dtype=np.uint8)))
+    bounds  = np.rint(np.arange(len(bits) + 1)*self.framesPerBit).astype(np.int64)
+    lengths = np.diff(bounds)
+    minLength = int(lengths.min())
+    numLengths = int(lengths.max()) - minLength + 1
+    waveforms = []
+    for bit in [0, 1]:
+      for length in range(minLength, minLength + numLengths):
+        waveforms.append(self._bitWaveform(bit, length))
+    starts    = np.cumsum([0] + [len(w) for w in waveforms[:-1]])
+    templates = self._quantize(np.concatenate(waveforms))
+    shift   = starts[bits.astype(np.int64)*numLengths + (lengths - minLength)] - bounds[:-1]
+    samples = np.empty(bounds[-1], dtype=templates.dtype)
+    for bi in range(0, len(bits), Config.chunkBits):
+      be = min(bi + Config.chunkBits, len(bits))
+      index = np.repeat(shift[bi:be], lengths[bi:be]) + np.arange(bounds[bi], bounds[be])
+      samples[bounds[bi]:bounds[be]] = templates[index]
+    return samples
+
+# Writes mono samples to a .wav file
+def writeWav(filename, samples, frameRate, bitDepth):
+  if bitDepth == 24:
+    frames = samples.astype('<i4').view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+  else:
+    frames = samples.astype(samples.dtype.newbyteorder('<')).tobytes()
+  try:
+    with wave.open(filename, 'wb') as wavFile:
+      wavFile.setnchannels(1)
+      wavFile.setsampwidth(bitDepth//8)
+      wavFile.setframerate(frameRate)
+      wavFile.writeframes(frames)
+  except OSError:
+    nascas.error("Cannot write to output file: " + filename)
+
+# The .cas content of a .cas or .nas file.  A file with the .cas extension
+# isn't checked, as a NAP .cas file doesn't begin like a NAS-SYS one
+def casData(filename):
+  if os.path.splitext(filename)[1].lower() == '.cas' or nascas.CasFile.isValid(filename):
+    try:
+      with open(filename, 'rb') as casFile:
+        return casFile.read()
+    except OSError:
+      nascas.error("Cannot open input file: " + filename)
+  if nascas.NasFile.isValid(filename):
+    inputData = nascas.InputData()
+    inputData.initWithNas(filename)
+    return nascas.CasFile.encode(inputData)
+  nascas.error("Input file is not a valid NAS or CAS file")
+
+# Converts params.inputFilename to params.outputFilename
+def convert(params):
+  data = casData(params.inputFilename)
+  if not params.silent:
+    print(f'Encoding {len(data)} bytes at {params.baud} baud...')
+  samples = KcsEncoder(params).encode(data)
+  if not params.silent:
+    print(f'Writing {len(samples)/params.frameRate:.2f}s to output file: {params.outputFilename}...')
+  writeWav(params.outputFilename, samples, params.frameRate, params.bitDepth)
+
+def main():
+  params = Params().parse()
+  try:
+    convert(params)
+  except nascas.NasError as nasError:
+    print("ERROR: " + nasError.args[0])
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,248 @@
+# Author: Peter Jensen
+#
+# Batch conversion of a tape archive: .wav -> .cas -> .nas (and .asm)
+#
+# Usage: nasbatch.py [options] <directory or pattern> ...
+#
+# Each .wav file is converted in a separate worker process.  The results
+# and errors for all files are collected in a summary report
+#
+import sys
+import os
+import io
+import glob
+import json
+import time
+import shlex
+import contextlib
+import concurrent.futures
+
+import wavcas
+import nascas
+import casasm
+
+class Params:
+  def __init__(self):
+    self.inputs     = []
+    self.workers    = os.cpu_count()
+    self.outputDir  = None
+    self.asm        = False
+    self.reportFile = None
+    self.wavOptions = []
+    self.inputRoots = {}  # the input directory of each .wav file found
+
+  @staticmethod
+  def usage():
+    print(
+'''Converts all .wav files in the given directories (searched recursively) or
+matching the given glob patterns to .cas and .nas files, using a pool of
+worker processes.
+
+Invocation:
+  nasbatch.py [-?][-j n][-d dir][-a][-r file][-w options] <directory or pattern> ...
+
+where:
+  -?          Prints this information
+  -j n        Number of worker processes. Default: number of CPUs
+  -d dir      Output directory. The files keep their path relative to the
+              input directory, or to the directory part of the pattern
+              before any wildcard. Default: the directory of each .wav file
+  -a          Also convert the .cas files to NAP assembly source text (.asm)
+  -r file     Writes the summary report as JSON to file
+  -w options  Options passed to wavcas.py, e.g. -w "-n 3 -o"
+''')
+
+  @staticmethod
+  def paramError(msg = ''):
+    if msg != '':
+      print("ERROR: " + msg)
+    print("Usage: " + sys.argv[0] + " [-?][-j n][-d dir][-a][-r file][-w options] <directory or pattern> ...")
+    print("Use -? to see detailed usage information")
+    sys.exit(1)
+
+  def parse(self, argv = None):
+    if argv == None:
+      argv = sys.argv
+    pi = 1
+    while pi < len(argv):
+      arg = argv[pi]
+      if arg == '-?':
+        self.usage()
+        sys.exit(0)
+      elif arg == '-a':
+        self.asm = True
+      elif arg in ['-j', '-d', '-r', '-w']:
+        pi += 1
+        if pi >= len(argv):
+          self.paramError(arg + ' must be followed by a value')
+        value = argv[pi]
+        if arg == '-j':
+          self.workers = wavcas.Params.toInt(value)
+          if self.workers == None or self.workers < 1:
+            self.paramError("Illegal value for -j parameter")
+        elif arg == '-d':
+          self.outputDir = value
+        elif arg == '-r':
+          self.reportFile = value
+        else:
+          self.wavOptions = shlex.split(value)
+      else:
+        self.inputs.append(arg)
+      pi += 1
+    if len(self.inputs) == 0:
+      self.paramError("No input directories or patterns specified")
+    # validate the wavcas options once, instead of failing in every worker
+    wavcas.Params().parse(['wavcas.py'] + self.wavOptions + ['check.wav'])
+    return self
+
+  # The directories of a pattern before the first one with a wildcard
+  @staticmethod
+  def patternRoot(pattern):
+    root = os.path.dirname(pattern)
+    while glob.has_magic(root):
+      root = os.path.dirname(root)
+    return root
+
+  def wavFilenames(self):
+    filenames = []
+    for inp in self.inputs:
+      if os.path.isdir(inp):
+        found = glob.glob(os.path.join(glob.escape(inp), '**', '*.wav'), recursive=True)
+        root  = inp
+      else:
+        found = glob.glob(inp, recursive=True)
+        root  = self.patternRoot(inp)
+      for f in sorted(f for f in found if f not in self.inputRoots):
+        filenames.append(f)
+        self.inputRoots[f] = root
+    return filenames
+
+  # With an output directory, the path of the .wav file relative to its input
+  # directory is kept under it, so files with the same name in different
+  # subdirectories don't overwrite each other
+  def outputFilename(self, wavFilename, ext):
+    if self.outputDir == None:
+      return os.path.splitext(wavFilename)[0] + ext
+    root = self.inputRoots.get(wavFilename, os.path.dirname(wavFilename))
+    relative = os.path.relpath(wavFilename, root or os.curdir)
+    return os.path.join(self.outputDir, os.path.splitext(relative)[0] + ext)
+
+  # The .wav files whose outputs have the same name as those of an earlier
+  # file, as (file, earlier file) pairs.  Only possible with an output
+  # directory and several inputs
+  def outputClashes(self, wavFilenames):
+    clashes = []
+    seen = {}
+    for f in wavFilenames:
+      name = os.path.normcase(os.path.normpath(self.outputFilename(f, '.cas')))
+      if name in seen:
+        clashes.append((f, seen[name]))
+      else:
+        seen[name] = f
+    return clashes
+
+# Converts one .wav file.  Runs in a worker process; the output of the
+# converters is captured and returned as part of the result
+def convertFile(params, wavFilename):
+  result = {
+    'input':        wavFilename,
+    'outputs':      [],
+    'status':       'ok',
+    'error':        None,
+    'bytes':        0,
+    'decodeErrors': 0,
+    'badBlocks':    [],
+    'tunedOptions': None,
+    'stages':       {},
+    'counters':     {},
+    'seconds':      0.0,
+  }
+  output = io.StringIO()
+  startTime = time.perf_counter()
+  try:
+    with contextlib.redirect_stdout(output):
+      casFilename = params.outputFilename(wavFilename, '.cas')
+      wavParams = wavcas.Params().parse(['wavcas.py'] + params.wavOptions + [wavFilename, casFilename])
+      wavParams.plot = None
+      decoder = wavcas.convert(wavParams)
+      result['bytes'] = decoder.numBytes
+      result['decodeErrors'] = decoder.log.errorCount
+      result['tunedOptions'] = decoder.tunedOptions
+      stats = decoder.stats.toDict()
+      result['stages']   = stats['stages']
+      result['counters'] = stats['counters']
+      result['outputs'].append(casFilename)
+
+      nasFilename = params.outputFilename(wavFilename, '.nas')
+      inputData = nascas.InputData()
+      inputData.initWithCas(casFilename)
+      nascas.NasFile(inputData, nasFilename).write()
+      result['badBlocks'] = inputData.badBlocks
+      result['outputs'].append(nasFilename)
+
+      if params.asm:
+        asmFilename = params.outputFilename(wavFilename, '.asm')
+        with open(casFilename, 'rb') as casFile:
+          lines = casasm.decode(casFile.read())
+        with open(asmFilename, 'w') as asmFile:
+          asmFile.write(''.join(l + '\n' for l in lines))
+        result['outputs'].append(asmFilename)
+  except (wavcas.DecodeError, nascas.NasError) as conversionError:
+    result['status'] = 'error'
+    result['error'] = 'ERROR: ' + conversionError.args[0]
+  except Exception as ex:
+    result['status'] = 'error'
+    result['error'] = f'{type(ex).__name__}: {ex}'
+  result['seconds'] = round(time.perf_counter() - startTime, 3)
+  result['log'] = output.getvalue()
+  return result
+
+def convertAll(params, wavFilenames):
+  results = {}
+  with concurrent.futures.ProcessPoolExecutor(max_workers=params.workers) as pool:
+    futures = {pool.submit(convertFile, params, f): f for f in wavFilenames}
+    for future in concurrent.futures.as_completed(futures):
+      result = future.result()
+      results[result['input']] = result
+      status = 'OK   ' if result['status'] == 'ok' else 'ERROR'
+      print(f'{status} {result["input"]} ({result["seconds"]:.2f}s)')
+  return [results[f] for f in wavFilenames]
+
+def printSummary(results, seconds):
+  print()
+  print(f'{"File":40} {"Status":6} {"Bytes":>7} {"Errors":>6} {"Bad blocks":>10} {"Time":>7}')
+  for r in results:
+    name = os.path.basename(r['input'])
+    print(f'{name:40} {r["status"]:6} {r["bytes"]:7} {r["decodeErrors"]:6} ' +
+          f'{len(r["badBlocks"]):10} {r["seconds"]:6.2f}s')
+    if r['error'] != None:
+      print(f'  {r["error"]}')
+  failed = sum(1 for r in results if r['status'] != 'ok')
+  print(f'{len(results)} files converted in {seconds:.2f}s. {failed} failed.')
+
+def main():
+  params = Params().parse()
+  wavFilenames = params.wavFilenames()
+  if len(wavFilenames) == 0:
+    print("ERROR: No .wav files found")
+    sys.exit(1)
+  if params.outputDir != None:
+    clashes = params.outputClashes(wavFilenames)
+    for f, earlier in clashes:
+      print(f'ERROR: {f} would overwrite the output of {earlier}')
+    if len(clashes) > 0:
+      sys.exit(1)
+    for outputDir in sorted({os.path.dirname(params.outputFilename(f, '.cas')) for f in wavFilenames}):
+      os.makedirs(outputDir, exist_ok=True)
+  startTime = time.perf_counter()
+  results = convertAll(params, wavFilenames)
+  seconds = time.perf_counter() - startTime
+  printSummary(results, seconds)
+  if params.reportFile != None:
+    with open(params.reportFile, 'w') as reportFile:
+      json.dump({'seconds': round(seconds, 3), 'files': results}, reportFile, indent=2)
+  if any(r['status'] != 'ok' for r in results):
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -8,21 +8,28 @@
 # output file type will be .cas and vice versa
 #
 import sys
+import io
 import re
 import os
+import mmap
+
+# An error that ends a conversion.  The scripts print it and exit
+class NasError(Exception):
+  pass
 
 def error(msg):
-  print("ERROR: " + msg)
-  sys.exit(1)
+  raise NasError(msg)
 
 class Params:
-  def parse(self):
-    if len(sys.argv) < 2:
-      print("Usage: " + sys.argv[0] + " <input file> [<output file>]")
+  def parse(self, argv = None):
+    if argv == None:
+      argv = sys.argv
+    if len(argv) < 2:
+      print("Usage: " + argv[0] + " <input file> [<output file>]")
       error("Unexpected invocation")
-    self.inputFilename = sys.argv[1]
-    if len(sys.argv) == 3:
-      self.outputFilename = sys.argv[2]
+    self.inputFilename = argv[1]
+    if len(argv) == 3:
+      self.outputFilename = argv[2]
     else:
       name, ext = os.path.splitext(os.path.basename(self.inputFilename))
       if ext.lower() == '.cas':
@@ -38,48 +45,83 @@ class InputData:
       checksum += b
     return checksum & 0xff
     
-  def __init__(self):
+  def __init__(self, printErrors = True):
     self.startAddress = None
     self.data = bytearray()
+    self.badBlocks = []  # block counts of blocks with checksum errors
+    self.numBlocks = 0   # blocks read from a .cas file
+    self.badLines  = []  # addresses of .nas lines with checksum errors
+    self.printErrors = printErrors
   def initWithNas(self, filename):
     try:
-      lines = [l.strip() for l in open(filename, 'r').readlines()]
+      file = open(filename, 'r', encoding='latin-1', newline=None)
     except:
       error("Cannot open input file: " + filename)
     else:
-      # 8 bytes per line
-      for line in lines:
-        if line[0] == '.':
-          break
-        if self.startAddress == None:
-          self.startAddress = int(line[0:4], 16)
-        self.data.extend(bytes.fromhex(line[5:5+8*3]))
+      with file:
+        self._readNasLines(file)
+
+  # content is the text of a .nas file, as str or bytes
+  def initWithNasData(self, content):
+    if not isinstance(content, str):
+      content = bytes(content).decode('latin-1')
+    self._readNasLines(io.StringIO(content, newline=None))
+
+  # Reads the lines one at a time.  A line is the address, 8 bytes and a
+  # checksum of them all, in hex: AAAA DD DD DD DD DD DD DD DD CC.  Raises
+  # NasError for a line that isn't hex
+  def _readNasLines(self, lines):
+    for line in lines:
+      line = line.strip()
+      if line == '':
+        continue
+      if line[0] == '.':
+        break
+      try:
+        startAddress = int(line[0:4], 16)
+        values = bytes.fromhex(line[0:4+1+8*3+2])
+        if len(values) != 2+8+1:
+          # a line without a checksum
+          values = bytes.fromhex(line[5:5+8*3])
+      except ValueError:
+        error(f'Illegal line: {line}')
+      if self.startAddress == None:
+        self.startAddress = startAddress
+      if len(values) <= 8:
+        self.data.extend(values)
+        continue
+      self.data.extend(values[2:10])
+      checksum = sum(values[0:10]) & 0xff
+      if checksum != values[10]:
+        self.badLines.append(values[0]*256 + values[1])
+        if self.printErrors:
+          print(f'Unexpected checksum in line: {line[0:4]}. {checksum:02X} != {values[10]:02X}')
   def initWithCas(self, filename):
     try:
       file = open(filename, 'rb')
     except:
       error("Cannot open input file: " + filename)
     else:
-      content = file.read()
-      i = 256 # skip over the first 256 zeros
-      while i < len(content):
-        i += 5 # skip over block start marker
-        if self.startAddress == None:
-          self.startAddress = content[i] + 256*content[i+1]
-        blockLength = content[i+2]
-        blockCount  = content[i+3]
-        if blockLength == 0:
-          blockLength = 256
-        i += 5 # skip over block header
-        checksum = self.computeChecksum(content[i:i+blockLength])
-        self.data.extend(content[i:i+blockLength])
-        i += blockLength
-        if checksum != content[i]:
-          print(f'Unexpected checksum in block: {blockCount}. {checksum:02X} != {content[i]:02X}')
-        i += 1 # skip over data checksum
-        i += 10 # skip over block end marker
-        if blockCount == 0:
-          break
+      self.initWithCasData(file.read())
+
+  # Reads the first file in the content.  Raises NasError if the content
+  # ends in the middle of a block of it.  The blocks before it have been read
+  def initWithCasData(self, content):
+    tape = CasTape(content)
+    if len(tape.files) > 0:
+      self.initWithCasFile(tape.files[0])
+    if tape.truncated and len(tape.files) <= 1:
+      error(f'Unexpected end of .cas data in block {self.numBlocks}')
+
+  def initWithCasFile(self, casFile):
+    self.startAddress = casFile.startAddress
+    for block in casFile.blocks:
+      self.data.extend(block.data)
+      self.numBlocks += 1
+      if not block.dataOk:
+        self.badBlocks.append(block.count)
+        if self.printErrors:
+          print(f'Unexpected checksum in block: {block.count}. {block.dataChecksum():02X} != {block.checksum:02X}')
 
 class CasFile:
   class FileHeader:
@@ -134,21 +176,220 @@ class CasFile:
     except:
       error("Cannot open output file: " + filename)
 
-  def write(self):
-    self.file.write(self.FileHeader.encode())
+  # The .cas file content for inputData
+  @classmethod
+  def encode(cls, inputData):
+    enc = bytearray(cls.FileHeader.encode())
     blockSize = 256
     di = 0
-    addr = self.inputData.startAddress
-    count = (len(self.inputData.data) + blockSize - 1) // blockSize - 1
-    while di < len(self.inputData.data):
-      data = self.inputData.data[di:di+blockSize]
-      block = self.Block(addr, len(data), count, data)
-      self.file.write(block.encode())
+    addr = inputData.startAddress
+    count = (len(inputData.data) + blockSize - 1) // blockSize - 1
+    while di < len(inputData.data):
+      data = inputData.data[di:di+blockSize]
+      block = cls.Block(addr, len(data), count, data)
+      enc.extend(block.encode())
       count -= 1
       addr += blockSize
       di += blockSize
+    return enc
+
+  def write(self):
+    self.file.write(self.encode(self.inputData))
     self.file.close()
 
+# Index of the blocks in the content of a .cas file, built in one pass over
+# the block headers.  The data of a block is only copied when it is used, so
+# one program can be taken from a tape holding many, e.g. mapped with
+# fromFile, without reading the others.  A block is expected right after the
+# previous one (or the 256 leading zeros).  If neither its start marker nor,
+# with a marker damaged in a single byte, its header checksum matches there,
+# the next start marker is searched for.
+# A block with count 0 ends a file, and a tape can hold several files.  The
+# blocks of a file don't have to be at contiguous addresses
+class CasTape:
+  marker = bytes([0, 0xff, 0xff, 0xff, 0xff])
+  leader = 256  # zeros before the first block of a file
+  gap    = 10   # zeros after a block
+
+  class Block:
+    def __init__(self, content, offset, startAddress, length, count, headerOk, checksum):
+      self.content      = content
+      self.offset       = offset        # of the start marker
+      self.startAddress = startAddress
+      self.length       = length
+      self.count        = count
+      self.headerOk     = headerOk
+      self.checksum     = checksum      # data checksum read from the tape
+      self.dataOk       = self.dataChecksum() == checksum
+
+    @property
+    def dataOffset(self):
+      return self.offset + len(CasTape.marker) + 5
+
+    @property
+    def endAddress(self):
+      return self.startAddress + self.length
+
+    @property
+    def data(self):
+      return bytes(self.content[self.dataOffset:self.dataOffset + self.length])
+
+    def dataChecksum(self):
+      return sum(self.content[self.dataOffset:self.dataOffset + self.length]) & 0xff
+
+  class File:
+    def __init__(self, blocks):
+      self.blocks       = blocks
+      self.startAddress = blocks[0].startAddress
+
+    # True if the file ends with a block with count 0
+    @property
+    def complete(self):
+      return self.blocks[-1].count == 0
+
+    @property
+    def badBlocks(self):
+      return [b.count for b in self.blocks if not (b.headerOk and b.dataOk)]
+
+    # The data of all blocks, in the order they were read
+    @property
+    def data(self):
+      return b''.join(b.data for b in self.blocks)
+
+    # The address ranges loaded by the file, as (start, end) pairs
+    def ranges(self):
+      ranges = []
+      for block in sorted(self.blocks, key=lambda b: b.startAddress):
+        if len(ranges) > 0 and block.startAddress <= ranges[-1][1]:
+          ranges[-1] = (ranges[-1][0], max(ranges[-1][1], block.endAddress))
+        else:
+          ranges.append((block.startAddress, block.endAddress))
+      return ranges
+
+    # The bytes loaded at the addresses start..end-1.  Like the NAS-SYS R
+    # command, a block read later overwrites an earlier one
+    def read(self, start, end):
+      memory = bytearray(end - start)
+      loaded = bytearray(end - start)
+      for block in self.blocks:
+        lo = max(start, block.startAddress)
+        hi = min(end, block.endAddress)
+        if lo < hi:
+          di = block.dataOffset + lo - block.startAddress
+          memory[lo-start:hi-start] = block.content[di:di + hi - lo]
+          loaded[lo-start:hi-start] = b'\x01'*(hi - lo)
+      if loaded.count(0) > 0:
+        error(f'Addresses {start:04X}-{end-1:04X} are not all loaded by the file')
+      return bytes(memory)
+
+  # content is bytes, a bytearray or an mmap
+  def __init__(self, content):
+    if isinstance(content, memoryview):
+      content = content.tobytes()
+    self.content   = content
+    self.blocks    = []
+    self.files     = []
+    self.truncated = False  # the content ends in the middle of a block
+    self._index()
+
+  @classmethod
+  def fromFile(cls, filename):
+    try:
+      with open(filename, 'rb') as file:
+        return cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+    except ValueError:
+      return cls(b'')  # an empty file
+    except OSError:
+      error("Cannot open input file: " + filename)
+
+  # True if a block is likely to start at pos
+  def _isBlockAt(self, pos):
+    marker = self.content[pos:pos+len(self.marker)]
+    header = self.content[pos+len(self.marker):pos+len(self.marker)+5]
+    if len(header) < 5:
+      return False
+    if marker == self.marker:
+      return True
+    damaged = sum(1 for a, b in zip(marker, self.marker) if a != b)
+    return damaged == 1 and sum(header[0:4]) & 0xff == header[4]
+
+  def _index(self):
+    content    = self.content
+    pos        = self.leader
+    searchFrom = 0
+    fileFrom   = 0
+    while True:
+      if not self._isBlockAt(pos):
+        pos = content.find(self.marker, searchFrom)
+        if pos < 0:
+          break
+      hi = pos + len(self.marker)
+      header = content[hi:hi+5]
+      if len(header) < 5:
+        self.truncated = True
+        break
+      length = header[2] if header[2] != 0 else 256
+      end = hi + 5 + length + 1
+      if end > len(content):
+        self.truncated = True
+        break
+      self.blocks.append(self.Block(content, pos, header[0] + 256*header[1], length, header[3],
+                                    sum(header[0:4]) & 0xff == header[4], content[end-1]))
+      searchFrom = end
+      pos = end + self.gap
+      if header[3] == 0:
+        self.files.append(self.File(self.blocks[fileFrom:]))
+        fileFrom = len(self.blocks)
+        pos += self.leader
+    if fileFrom < len(self.blocks):
+      self.files.append(self.File(self.blocks[fileFrom:]))
+
+# Finds the blocks in a .cas byte stream while it is being decoded.  Blocks are
+# found by their start marker, so the stream can start anywhere, e.g. in the
+# middle of the leading zeros.  feed() returns the blocks completed by the
+# new bytes as (block, headerOk, dataOk).  block.checksum is the data
+# checksum read from the stream, block.offset the position of the block in
+# the stream and block.raw its bytes as read, without the gap after it
+class BlockScanner:
+  marker = bytes([0, 0xff, 0xff, 0xff, 0xff])
+
+  def __init__(self):
+    self.pending = bytearray()
+    self.offset  = 0  # of pending[0] in the stream
+
+  def _drop(self, n):
+    del self.pending[:n]
+    self.offset += n
+
+  def feed(self, content):
+    self.pending.extend(content)
+    blocks = []
+    while True:
+      mi = self.pending.find(self.marker)
+      if mi < 0:
+        # keep a partial marker at the end
+        self._drop(max(0, len(self.pending) - len(self.marker) + 1))
+        return blocks
+      self._drop(mi)
+      hi = len(self.marker)
+      if len(self.pending) < hi + 5:
+        return blocks
+      startAddress = self.pending[hi] + 256*self.pending[hi+1]
+      length = self.pending[hi+2]
+      count  = self.pending[hi+3]
+      if length == 0:
+        length = 256
+      di = hi + 5
+      if len(self.pending) < di + length + 1:
+        return blocks
+      block = CasFile.Block(startAddress, length, count, bytes(self.pending[di:di+length]))
+      block.checksum = self.pending[di+length]
+      block.offset   = self.offset  # of the start marker
+      block.raw      = bytes(self.pending[0:di+length+1])
+      headerOk = block.headerChecksum() == self.pending[hi+4]
+      blocks.append((block, headerOk, block.dataChecksum() == block.checksum))
+      self._drop(di+length+1)
+
 class NasFile:
   class Line:
     def __init__(self, startAddress, data):
@@ -193,22 +434,73 @@ class NasFile:
     except:
       error("Cannot open output file: " + filename)
 
-  def write(self):
-    di = 0
+  # The .nas file content for inputData, built in one buffer.  The data
+  # bytes are converted to hex all at once, and the addresses and checksums
+  # are looked up in hexTable
+  hexTable = [f'{b:02X}'.encode() for b in range(256)]
+
+  @classmethod
+  def encode(cls, inputData):
     lineDataSize = 8
-    addr = self.inputData.startAddress
-    while di < len(self.inputData.data):
-      lineData = self.inputData.data[di:di+lineDataSize]
-      while len(lineData) < lineDataSize:
-        lineData.append(0x00)
-      line = self.Line(addr, lineData)
-      self.file.write(line.encode())
-      di += lineDataSize
+    data = bytes(inputData.data)
+    if len(data) % lineDataSize != 0:
+      data += bytes(lineDataSize - len(data) % lineDataSize)
+    hexData  = data.hex(' ').upper().encode()
+    hexTable = cls.hexTable
+    lineHex  = 3*lineDataSize - 1
+    lines = []
+    addr = inputData.startAddress
+    for di in range(0, len(data), lineDataSize):
+      hi = addr >> 8
+      checksum = ((addr & 0xff) + hi + sum(data[di:di+lineDataSize])) & 0xff
+      lines.append(b'%s%s %s %s\x08\x08\x0d\x0a' % (hexTable[hi] if hi < 256 else b'%02X' % hi,
+                                                 hexTable[addr & 0xff], hexData[3*di:3*di+lineHex],
+                                                 hexTable[checksum]))
       addr += lineDataSize
-    self.file.write(bytes([ord('.'), 0xa]))
+    lines.append(b'.\x0a')
+    return b''.join(lines)
+
+  def write(self):
+    self.file.write(self.encode(self.inputData))
     self.file.close()
 
+# Library API.  A source is a file name, a binary file object or a buffer.
+# The functions return the converted content, and raise NasError instead of
+# printing and exiting.  Blocks with checksum errors are converted as is
+def readSource(source):
+  if isinstance(source, (str, os.PathLike)):
+    try:
+      with open(source, 'rb') as file:
+        return file.read()
+    except OSError:
+      error("Cannot open input file: " + os.fspath(source))
+  if hasattr(source, 'read'):
+    return source.read()
+  return bytes(source)
+
+# .cas content to .nas content.  file is the number of the file on the tape
+def casToNas(source, file = 0):
+  tape = CasTape(readSource(source))
+  if file >= len(tape.files):
+    error(f'No file {file} on the tape.  Number of files: {len(tape.files)}')
+  inputData = InputData(printErrors = False)
+  inputData.initWithCasFile(tape.files[file])
+  return bytes(NasFile.encode(inputData))
+
+# .nas content to .cas content
+def nasToCas(source):
+  inputData = InputData(printErrors = False)
+  inputData.initWithNasData(readSource(source))
+  return bytes(CasFile.encode(inputData))
+
 def main():
+  try:
+    convert()
+  except NasError as nasError:
+    print("ERROR: " + nasError.args[0])
+    sys.exit(1)
+
+def convert():
   params = Params()
   params.parse()
   inputData = InputData()
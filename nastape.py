@@ -0,0 +1,24 @@
+# Author: Peter Jensen
+#
+# Library API for the converters, for using them in-process instead of
+# running the scripts
+#
+#   decodeWav(source, options) -> DecodeResult   .wav to .cas (wavcas.py)
+#   casToNas(source, file) -> bytes              .cas to .nas (nascas.py)
+#   nasToCas(source) -> bytes                    .nas to .cas (nascas.py)
+#   casToText(source) -> str                     NAP source text of a .cas
+#                                                file (casasm.py)
+#   textToCas(source, title) -> bytes            NAP .cas file with the
+#                                                source text (casasm.py)
+#   CasTape(content)                             index of the blocks and
+#                                                files on a tape (nascas.py)
+#
+# A source is a file name, a binary file object or a buffer (bytes,
+# bytearray, memoryview or mmap).  Nothing is printed, and errors raise
+# DecodeError, NasError or, for illegal decodeWav options, ValueError.
+# The functions don't share any state, so they can be called from several
+# threads at once
+#
+from wavcas import decodeWav, DecodeResult, DecodeError
+from nascas import casToNas, nasToCas, NasError, CasTape
+from casasm import casToText, textToCas
@@ -4,7 +4,8 @@
 #
 # Usage: wavcas.py <input-file> <output-file>
 #
-# Wav file (unsigned 8 bit samples):
+# Wav file (8, 16, 24 or 32 bit PCM, or 32/64 bit float samples, one or more
+# channels).  Samples are converted to unsigned 8 bit mono before decoding:
 #  0: 1 cycle of 1200Hz
 #  1: 2 cycles of 2400Hz
 #  A byte is encoded as (18N1):
@@ -13,58 +14,192 @@
 #    1:     stop-bit
 
 import sys
-import wave
-import matplotlib.pyplot as plt
+import copy
+import queue
+import mmap
+import shutil
+import hashlib
+import tempfile
+import time
+import json
+import struct
+import contextlib
+import bisect
+import itertools
+import concurrent.futures
+from multiprocessing import shared_memory
+import numpy as np
 import os
 
+import nascas
+
 # Poor man's enum
 crossUp   = 1
 crossDown = 2
 
-# Error and information output control
+# An error that ends a conversion.  The script prints it and exits
+class DecodeError(Exception):
+  pass
+
+# Error and information output control.  One instance per conversion; it
+# also counts the errors reported during the conversion
 class Log:
-  @staticmethod
-  def errorExit(msg):
-    print("ERROR: " + msg)
-    sys.exit(1)
+  def __init__(self, params):
+    self.params     = params
+    self.errorCount = 0
+    self.errors     = []  # the error messages, e.g. for caching
 
   @staticmethod
-  def error(msg):
-    print("ERROR: " + msg)
+  def fatal(msg):
+    raise DecodeError(msg)
 
-  @staticmethod
-  def info(msg):
-    if not Params.silent:
+  def error(self, msg):
+    self.errorCount += 1
+    self.errors.append(msg)
+    if self.params.printErrors:
+      print("ERROR: " + msg)
+
+  def info(self, msg):
+    if not self.params.silent:
       print(msg)
 
-  @staticmethod
-  def progress(msg):
-    if not Params.silent:
+  def progress(self, msg):
+    if not self.params.silent:
       print(msg + '...')
 
-  @staticmethod
-  def verbose(msg):
-    if (Params.verbose):
+  def verbose(self, msg):
+    if (self.params.verbose):
       print(msg)
 
+# Timers and counters for one decoding.  Every stage is timed once, and
+# framing errors are only recorded when they occur, so collecting the stats
+# costs next to nothing; they are only formatted when metrics are requested
+class DecodeStats:
+  framingErrorKinds = ['tooManyBits', 'startBit', 'stopBit']
+
+  def __init__(self):
+    self.stages        = {}  # stage name -> seconds, in the order the stages ran
+    self.counters      = {kind + 'Errors': 0 for kind in self.framingErrorKinds}
+    self.framingErrors = []  # (byte number, seconds into the recording, kind)
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.addStage(name, time.perf_counter() - start)
+
+  def addStage(self, name, seconds):
+    self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+  def setCounter(self, name, value):
+    self.counters[name] = value
+
+  def framingError(self, kind, byteNum, seconds):
+    self.counters[kind + 'Errors'] += 1
+    self.framingErrors.append((byteNum, seconds, kind))
+
+  def toDict(self):
+    return {
+      'stages':        {name: round(t, 6) for name, t in self.stages.items()},
+      'counters':      dict(self.counters),
+      'framingErrors': [{'byte': b, 'seconds': round(t, 5), 'error': k} for b, t, k in self.framingErrors],
+    }
+
+  def toJson(self):
+    return json.dumps(self.toDict(), indent=2)
+
+  @staticmethod
+  def _lineValue(value):
+    if isinstance(value, int):
+      return f'{value}i'
+    return repr(float(value))
+
+  @staticmethod
+  def _lineTag(value):
+    return str(value).replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+  # InfluxDB line protocol: one 'wavcas' line with the counters, a
+  # 'wavcas_stage' line per stage and a 'wavcas_framing_error' line per error
+  def toLineProtocol(self, tags, timestamp = None):
+    if timestamp == None:
+      timestamp = time.time_ns()
+    tagText = ''.join(f',{k}={self._lineTag(v)}' for k, v in tags.items())
+    fields  = ','.join(f'{k}={self._lineValue(v)}' for k, v in self.counters.items())
+    lines   = [f'wavcas{tagText} {fields} {timestamp}']
+    for name, seconds in self.stages.items():
+      lines.append(f'wavcas_stage{tagText},stage={name} seconds={seconds!r} {timestamp}')
+    for byteNum, seconds, kind in self.framingErrors:
+      lines.append(f'wavcas_framing_error{tagText},error={kind} byte={byteNum}i,seconds={seconds!r} {timestamp}')
+    return ''.join(line + '\n' for line in lines)
+
+  # Writes the stats as JSON if the filename ends in .json, otherwise as line
+  # protocol. '-' writes to standard out
+  def write(self, filename, tags):
+    if filename.endswith('.json'):
+      text = self.toJson() + '\n'
+    else:
+      text = self.toLineProtocol(tags)
+    if filename == '-':
+      sys.stdout.write(text)
+      return
+    try:
+      with open(filename, 'w') as metricsFile:
+        metricsFile.write(text)
+    except OSError:
+      Log.fatal("Cannot write to metrics file: " + filename)
+
 class Config:
   baseFreq       = 2400  # frequency of 1-bit
   maxSampleCount = 4000  # max samples used to determine framesPerBit
   minAmplitude   = 2
   maxBitsPerByte = 13
+  channelProbe   = 10.0  # seconds of audio used to pick the strongest channel
+  segmentOverlap = 32    # bytes decoded into the next segment when decoding in parallel
+  bandPassLow    = 800   # pass band of the bandpass noise filter (Hz)
+  bandPassHigh   = 3600
+  engines        = ['crossings', 'goertzel']  # bit classifiers
+  clocks         = ['fixed', 'pll']           # clock recovery
+  cacheSize      = 1 << 30  # max bytes in the decoding cache
+  liveChunkFrames = 1024  # max frames passed to the decoder at a time when decoding live
+  liveProbe      = 1.0   # seconds of live audio used to pick the strongest channel
+  programGap     = 128   # min bytes between two blocks that starts a new program
+  pllGain        = 0.1   # fraction of the bit period error corrected per byte
+  pllLockRange   = 0.5   # max bits a byte may be off to be used for tracking
+  repairClockScales = [0.99, 1.01, 0.98, 1.02]  # bit periods tried for damaged blocks
+  confidenceBatch = 4096  # bytes whose bits are classified, or rated, at a time
+  crossingBatch  = 1 << 18  # frames, and crossings, indexed at a time
+  weakConfidence = 64     # bytes with a bit below this confidence are reported
 
+# Options for one conversion
 class Params:
-  inputFilename   = None
-  outputFilename  = None
-  verbose         = False
-  silent          = False
-  offsetAdjust    = False
-  plot            = None
-  framesPerBit    = None
-  noiseWindow     = None
-  dataBits        = 8
-  stopBits        = 1
-  bitsPerByte     = 1 + dataBits + stopBits
+  def __init__(self):
+    self.inputFilename   = None
+    self.outputFilename  = None
+    self.verbose         = False
+    self.silent          = False
+    self.offsetAdjust    = False
+    self.plot            = None
+    self.framesPerBit    = None
+    self.noiseWindow     = None
+    self.noiseFilter     = 'mean'
+    self.chunkFrames     = None
+    self.channel         = None
+    self.jobs            = None
+    self.metricsFile     = None
+    self.engine          = 'crossings'
+    self.clock           = 'fixed'
+    self.autoTune        = False
+    self.cacheDir        = None
+    self.liveRate        = None
+    self.splitDir        = None
+    self.repairBlocks    = False
+    self.confidenceFile  = None
+    self.printErrors     = True
+    self.dataBits        = 8
+    self.stopBits        = 1
+    self.bitsPerByte     = 1 + self.dataBits + self.stopBits
 
   @staticmethod
   def usage():
@@ -81,21 +216,73 @@ where:
   -s    Turns on silent mode
   -o    Use offset adjust per bit
   -n n  Noise reduction window size
+  -k f  Noise reduction filter: mean, median or bandpass. Default: mean.
+        For bandpass, n is the filter length, e.g. 71 for 44.1kHz
   -f n  Expected frames per bit
+  -e e  Bit classifier: crossings or goertzel. Default: crossings.
+        crossings uses the spacing of the zero crossings in a bit, goertzel
+        compares the energy at 1200Hz and 2400Hz
   -t n  Number of stop bits (1 or 2). Default: 1
+  -r r  Clock recovery: fixed or pll. Default: fixed.
+        fixed estimates one bit period from the start of the recording,
+        pll tracks the bit period while decoding.  pll cannot be combined
+        with -c, -l or -j
   -p n  Plots the input wav data for byte n. n can be specified as hex (0xnn) or decimal
+  -c n  Stream the input in chunks of n frames.  Keeps memory use bounded for long
+        recordings.  Cannot be combined with -p
+  -m n  Channel to decode in stereo/multi-channel files (0 is left, 1 is right).
+        Default: the channel with the strongest signal
+  -j n  Decode with n processes.  The recording is split at block boundaries,
+        and the segments are decoded in parallel.  Cannot be combined with -c
+  -a    Auto tune: decodes with all combinations of noise reduction (none,
+        -n 3, -n 5 and bandpass), offset adjust and stop bits in parallel, and
+        keeps the one with the most valid NAS-SYS blocks and the fewest
+        framing errors.  With -a, -j n is the number of processes.  Default:
+        number of CPUs.  Cannot be combined with -c
+  -b    Repairs the NAS-SYS blocks with checksum errors.  Only the audio of a
+        damaged block is decoded again, with other noise reduction, offset
+        adjust and bit classifier options and slightly off bit periods, and
+        the first variant giving valid checksums replaces the block.  If
+        none does, the weakest bits of the block are flipped until its
+        checksum matches.  Cannot be combined with -c or -l
+  -d d  Caches the decoding in directory d.  Running again on the same .wav
+        file with the same decoding options, e.g. to plot another byte,
+        reuses the filtered frames, zero crossings, start bits and bytes.
+        The least recently used entries are removed when the cache exceeds
+        1GB.  Not used with -c
+  -l r  Live decoding of a tape while it is playing.  The input is read as it
+        arrives from a pipe, a FIFO or - for standard in, and the NAS-SYS
+        blocks are reported as soon as they are decoded.  The input is
+        raw unsigned 8 bit mono frames at r frames per second, or a .wav
+        stream, e.g. from arecord or sox, in which case r is ignored.
+        -c n sets the max frames decoded at a time. Default: 1024.
+        Cannot be combined with -p, -j, -a or -d
+  -g d  Splits the tape into its programs while decoding.  Each program is
+        written to directory d as NN-AAAA.cas and NN-AAAA.nas, where NN is
+        its number on the tape and AAAA its start address, and d/manifest.json
+        lists the programs with their address ranges, start and end time in
+        the recording and the blocks with checksum errors.  A program ends
+        with its block 00, when the block count goes up, or at a leader
+  -q f  Writes the confidence of each decoded byte to file f as CSV: the byte
+        number, the time of its start bit, its value, its confidence and the
+        confidences of its bits.  A bit's confidence, 0 to 255, is how
+        strongly the energies at 1200Hz and 2400Hz support the decoded value,
+        and a byte's confidence is the lowest of its bits
+  -x f  Writes decoding metrics (stage times, counters and framing errors) to
+        file f.  JSON if f ends in .json, otherwise InfluxDB line protocol.
+        Use - for standard out
 ''')
 
   @staticmethod
   def paramError(msg = ''):
     if msg != '':
-      Log.error(msg)
+      print("ERROR: " + msg)
     print("Usage: " + sys.argv[0] + " [-?][-v][-p n] <input file> <output file>")
     print("Use -? to see detailed usage information")
     sys.exit(1)
 
-  @classmethod
-  def toInt(cls, s):
+  @staticmethod
+  def toInt(s):
     try:
       if s[0:2] == '0x':
         return int(s[2:], 16)
@@ -104,83 +291,677 @@ where:
     except:
       return None
 
+  # The options that can't be combined, if any
+  def conflict(self):
+    if self.chunkFrames != None and self.plot != None:
+      return "-p cannot be combined with -c"
+    if self.chunkFrames != None and self.jobs != None:
+      return "-j cannot be combined with -c"
+    if self.chunkFrames != None and self.autoTune:
+      return "-a cannot be combined with -c"
+    if self.repairBlocks and (self.chunkFrames != None or self.liveRate != None):
+      return "-b cannot be combined with -c or -l"
+    if self.liveRate != None and (self.plot != None or self.jobs != None or self.autoTune or
+                                  self.cacheDir != None):
+      return "-l cannot be combined with -p, -j, -a or -d"
+    if self.clock == 'pll' and (self.chunkFrames != None or self.liveRate != None or
+                                (self.jobs != None and not self.autoTune)):
+      return "-r pll cannot be combined with -c, -l or -j"
+    return None
+
+  # Valid values of the options of decodeWav
+  optionChecks = {
+    'channel':      lambda v: v == None or (type(v) == int and v >= 0),
+    'noiseWindow':  lambda v: v == None or (type(v) == int and v > 0 and v & 1 == 1),
+    'noiseFilter':  lambda v: v in FrameFilter.noiseFilters,
+    'offsetAdjust': lambda v: type(v) == bool,
+    'framesPerBit': lambda v: v == None or (type(v) in [int, float] and v > 0),
+    'engine':       lambda v: v in Config.engines,
+    'clock':        lambda v: v in Config.clocks,
+    'stopBits':     lambda v: v in [1, 2],
+    'jobs':         lambda v: v == None or (type(v) == int and v >= 1),
+    'autoTune':     lambda v: type(v) == bool,
+    'repairBlocks': lambda v: type(v) == bool,
+  }
+
+  # Params for decodeWav.  options is a dict with values for the names in
+  # optionChecks.  Nothing is printed, not even errors
   @classmethod
-  def parse(cls):
+  def fromOptions(cls, options = None):
+    params = cls()
+    params.silent      = True
+    params.printErrors = False
+    for name, value in (options or {}).items():
+      if name not in cls.optionChecks:
+        raise ValueError(f'Unknown option: {name}')
+      if not cls.optionChecks[name](value):
+        raise ValueError(f'Illegal value for option {name}: {value!r}')
+      setattr(params, name, value)
+    params.bitsPerByte = 1 + params.dataBits + params.stopBits
+    conflict = params.conflict()
+    if conflict != None:
+      raise ValueError(conflict)
+    return params
+
+  def parse(self, argv = None):
+    if argv == None:
+      argv = sys.argv
     pi = 1
-    while pi < len(sys.argv):
-      arg = sys.argv[pi]
+    while pi < len(argv):
+      arg = argv[pi]
       if arg == '-?':
-        cls.usage()
+        self.usage()
         sys.exit(0)
       elif arg == '-v':
-        cls.verbose = True
+        self.verbose = True
       elif arg == '-s':
-        cls.silent = True
+        self.silent = True
       elif arg == '-o':
-        cls.offsetAdjust = True
+        self.offsetAdjust = True
+      elif arg == '-a':
+        self.autoTune = True
+      elif arg == '-b':
+        self.repairBlocks = True
       elif arg == "-n":
         pi += 1
-        if pi >= len(sys.argv):
-          paramError('-n must be followed by a number')
-        cls.noiseWindow = cls.toInt(sys.argv[pi])
-        if cls.noiseWindow == None:
-          cls.paramError("Illegal number syntax for -n parameter")
-        if cls.noiseWindow & 1 == 0:
-          cls.paramError("Odd number required for -n parameter")
+        if pi >= len(argv):
+          self.paramError('-n must be followed by a number')
+        self.noiseWindow = self.toInt(argv[pi])
+        if self.noiseWindow == None:
+          self.paramError("Illegal number syntax for -n parameter")
+        if self.noiseWindow & 1 == 0:
+          self.paramError("Odd number required for -n parameter")
+      elif arg == '-k':
+        pi += 1
+        if pi >= len(argv):
+          self.paramError('-k must be followed by a filter name')
+        self.noiseFilter = argv[pi]
+        if self.noiseFilter not in FrameFilter.noiseFilters:
+          self.paramError("Illegal value for -k parameter.  Must be one of: " +
+                         ', '.join(FrameFilter.noiseFilters))
+      elif arg == '-e':
+        pi += 1
+        if pi >= len(argv):
+          self.paramError('-e must be followed by an engine name')
+        self.engine = argv[pi]
+        if self.engine not in Config.engines:
+          self.paramError("Illegal value for -e parameter.  Must be one of: " +
+                         ', '.join(Config.engines))
+      elif arg == '-r':
+        pi += 1
+        if pi >= len(argv):
+          self.paramError('-r must be followed by fixed or pll')
+        self.clock = argv[pi]
+        if self.clock not in Config.clocks:
+          self.paramError("Illegal value for -r parameter.  Must be one of: " +
+                         ', '.join(Config.clocks))
       elif arg == "-f":
         pi += 1
-        if pi >= len(sys.argv):
-          paramError('-t must be followed by a number')
-        cls.framesPerBit = cls.toInt(sys.argv[pi])
-        if cls.framesPerBit == None:
-          cls.paramError("Illegal number syntax for -f parameter")
+        if pi >= len(argv):
+          self.paramError('-t must be followed by a number')
+        self.framesPerBit = self.toInt(argv[pi])
+        if self.framesPerBit == None:
+          self.paramError("Illegal number syntax for -f parameter")
       elif arg == '-p':
         pi += 1
-        if pi >= len(sys.argv):
-          paramError('-p must be followed by a byte number (decimal or hex)')
-        cls.plot = cls.toInt(sys.argv[pi])
-        if cls.plot == None:
-          cls.paramError("Illegal number syntax for -p parameter")
+        if pi >= len(argv):
+          self.paramError('-p must be followed by a byte number (decimal or hex)')
+        self.plot = self.toInt(argv[pi])
+        if self.plot == None:
+          self.paramError("Illegal number syntax for -p parameter")
+      elif arg == '-c':
+        pi += 1
+        if pi >= len(argv):
+          self.paramError('-c must be followed by a number of frames')
+        self.chunkFrames = self.toInt(argv[pi])
+        if self.chunkFrames == None or self.chunkFrames <= 0:
+          self.paramError("Illegal value for -c parameter")
+      elif arg == '-j':
+        pi += 1
+        if pi >= len(argv):
+          self.paramError('-j must be followed by a number of processes')
+        self.jobs = self.toInt(argv[pi])
+        if self.jobs == None or self.jobs < 1:
+          self.paramError("Illegal value for -j parameter")
+      elif arg == '-m':
+        pi += 1
+        if pi >= len(argv):
+          self.paramError('-m must be followed by a channel number')
+        self.channel = self.toInt(argv[pi])
+        if self.channel == None or self.channel < 0:
+          self.paramError("Illegal value for -m parameter")
+      elif arg == '-d':
+        pi += 1
+        if pi >= len(argv):
+          self.paramError('-d must be followed by a directory')
+        self.cacheDir = argv[pi]
+      elif arg == '-l':
+        pi += 1
+        if pi >= len(argv):
+          self.paramError('-l must be followed by a frame rate')
+        self.liveRate = self.toInt(argv[pi])
+        if self.liveRate == None or self.liveRate <= 0:
+          self.paramError("Illegal value for -l parameter")
+      elif arg == '-g':
+        pi += 1
+        if pi >= len(argv):
+          self.paramError('-g must be followed by a directory')
+        self.splitDir = argv[pi]
+      elif arg == '-q':
+        pi += 1
+        if pi >= len(argv):
+          self.paramError('-q must be followed by a file name')
+        self.confidenceFile = argv[pi]
+      elif arg == '-x':
+        pi += 1
+        if pi >= len(argv):
+          self.paramError('-x must be followed by a file name')
+        self.metricsFile = argv[pi]
       elif arg == '-t':
         pi += 1
-        if pi >= len(sys.argv):
-          paramError('-t must be followed by a number (1 or 2')
-        cls.stopBits = cls.toInt(sys.argv[pi])
-        if cls.stopBits == None or cls.stopBits not in [1, 2]:
-          cls.paramError("Illegal value for -t parameter.  Must be 1 or 2")
-        cls.bitsPerByte = 1 + cls.dataBits + cls.stopBits
+        if pi >= len(argv):
+          self.paramError('-t must be followed by a number (1 or 2')
+        self.stopBits = self.toInt(argv[pi])
+        if self.stopBits == None or self.stopBits not in [1, 2]:
+          self.paramError("Illegal value for -t parameter.  Must be 1 or 2")
+        self.bitsPerByte = 1 + self.dataBits + self.stopBits
       else:
-        if cls.inputFilename == None:
-          cls.inputFilename = arg
-        elif cls.outputFilename == None:
-          cls.outputFilename = arg
+        if self.inputFilename == None:
+          self.inputFilename = arg
+        elif self.outputFilename == None:
+          self.outputFilename = arg
         else:
-          cls.paramError("Only two parameters allowed")
+          self.paramError("Only two parameters allowed")
       pi += 1
-    if cls.inputFilename == None:
-      cls.paramError("Input file not specified")
-    if cls.outputFilename == None:
-      cls.outputFilename = os.path.splitext(os.path.basename(cls.inputFilename))[0] + '.cas'
+    if self.inputFilename == None:
+      self.paramError("Input file not specified")
+    conflict = self.conflict()
+    if conflict != None:
+      self.paramError(conflict)
+    if self.outputFilename == None:
+      name = 'stdin' if self.inputFilename == '-' else os.path.splitext(os.path.basename(self.inputFilename))[0]
+      self.outputFilename = name + '.cas'
+    return self
+
+class WavError(Exception):
+  pass
+
+# The fmt and data chunks of a RIFF/WAVE file
+class WavHeader:
+  formatPcm        = 1
+  formatFloat      = 3
+  formatExtensible = 0xfffe
+
+  def __init__(self, file):
+    riff = file.read(12)
+    if len(riff) < 12 or riff[0:4] != b'RIFF' or riff[8:12] != b'WAVE':
+      raise WavError('not a RIFF/WAVE file')
+    self.formatTag  = None
+    self.dataOffset = None
+    while self.dataOffset == None:
+      chunkHeader = file.read(8)
+      if len(chunkHeader) < 8:
+        raise WavError('no data chunk')
+      chunkId, chunkSize = struct.unpack('<4sI', chunkHeader)
+      if chunkId == b'fmt ':
+        self._parseFormat(file.read(chunkSize))
+      elif chunkId == b'data':
+        if self.formatTag == None:
+          raise WavError('data chunk before fmt chunk')
+        self.dataOffset = file.tell()
+        self.dataSize   = chunkSize
+      else:
+        file.seek(chunkSize, os.SEEK_CUR)
+      if chunkSize & 1 and chunkId != b'data':
+        file.seek(1, os.SEEK_CUR)
+    # recorders that are stopped abruptly may leave a bogus data size
+    fileSize = file.seek(0, os.SEEK_END)
+    self.dataSize = min(self.dataSize, fileSize - self.dataOffset)
+    self.nFrames  = self.dataSize // self.blockAlign
+    file.seek(self.dataOffset)
+
+  # A header for a stream that can't be seeked in, or has no RIFF header,
+  # from the content of its fmt chunk.  The number of frames is unknown
+  @classmethod
+  def fromFormat(cls, fmt):
+    header = cls.__new__(cls)
+    header._parseFormat(fmt)
+    header.dataOffset = 0
+    header.dataSize   = None
+    header.nFrames    = 0
+    return header
+
+  def _parseFormat(self, fmt):
+    if len(fmt) < 16:
+      raise WavError('fmt chunk too short')
+    (self.formatTag, self.channels, self.frameRate, _,
+     self.blockAlign, self.bitsPerSample) = struct.unpack('<HHIIHH', fmt[0:16])
+    if self.formatTag == self.formatExtensible and len(fmt) >= 26:
+      self.formatTag = struct.unpack('<H', fmt[24:26])[0]
+    if self.channels == 0 or self.blockAlign % self.channels != 0:
+      raise WavError('inconsistent fmt chunk')
+    # samples are left aligned in their container, e.g. 20 bits in 3 bytes
+    self.sampleWidth = self.blockAlign // self.channels
+    if self.formatTag == self.formatPcm:
+      supported = self.sampleWidth in [1, 2, 3, 4]
+    elif self.formatTag == self.formatFloat:
+      supported = self.sampleWidth in [4, 8]
+    else:
+      supported = False
+    if not supported:
+      raise WavError(f'unsupported format: {self.formatTag}, {self.bitsPerSample} bits')
+
+# Converts raw frames in the format given by a WavHeader to the unsigned 8 bit
+# mono frames WavData works on, as a memoryview.  The conversion is done on
+# numpy views of the raw bytes.  8 bit mono frames are passed through as is,
+# so they stay a view of the memory-mapped file
+class FrameConverter:
+  def __init__(self, header, channel = None):
+    self.header  = header
+    self.channel = channel
+    if channel != None and channel >= header.channels:
+      raise WavError(f'channel {channel} not present. Number of channels: {header.channels}')
+    if header.channels == 1:
+      self.channel = 0
 
+  def _toUnsigned8(self, raw):
+    header = self.header
+    width  = header.sampleWidth
+    nBytes = len(raw) - len(raw) % header.blockAlign
+    raw    = memoryview(raw)[0:nBytes]
+    if header.formatTag == WavHeader.formatFloat:
+      samples = np.frombuffer(raw, dtype='<f4' if width == 4 else '<f8')
+      samples = np.clip(np.rint(samples*0x80), -0x80, 0x7f).astype(np.int16)
+    elif width == 1:
+      return np.frombuffer(raw, dtype=np.uint8).reshape(-1, header.channels)
+    elif width == 3:
+      triplets = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3)
+      # high byte and the rounding bit from the middle byte
+      samples  = triplets[:, 2].astype(np.int8).astype(np.int16)*2 + (triplets[:, 1] >> 7)
+      samples  = np.minimum((samples + 1) >> 1, 0x7f)
+    else:
+      samples = np.frombuffer(raw, dtype='<i2' if width == 2 else '<i4')
+      samples = np.minimum(((samples >> (8*width - 9)) + 1) >> 1, 0x7f).astype(np.int16)
+    return (samples + 0x80).astype(np.uint8).reshape(-1, header.channels)
+
+  # Picks the channel with the strongest signal, unless one was selected
+  def probe(self, raw):
+    if self.channel == None:
+      frames = self._toUnsigned8(raw).astype(np.float32)
+      self.channel = int(np.argmax(frames.std(axis=0))) if len(frames) > 0 else 0
+
+  def convert(self, raw):
+    header = self.header
+    if header.channels == 1 and header.sampleWidth == 1:
+      return memoryview(raw)
+    return memoryview(np.ascontiguousarray(self._toUnsigned8(raw)[:, self.channel]))
+
+# The data chunk of a wav file, memory-mapped.  Returns a read-only
+# memoryview of the frames; slicing it doesn't copy
+def _mapData(file, header):
+  size = header.nFrames*header.blockAlign
+  if size == 0:
+    return memoryview(b'')
+  data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+  return memoryview(data)[header.dataOffset:header.dataOffset + size]
+
+# The frames of a wav file.  The file is memory-mapped, so opening even a
+# very long 8 bit mono recording doesn't read or copy its frames, and
+# self.frames is a view of the mapped file.  Other formats are converted
+# straight from the mapped file
 class WavFile:
-  def __init__(self, filename):
+  def __init__(self, filename, params):
+    try:
+      with open(filename, 'rb') as file:
+        header = WavHeader(file)
+        raw = _mapData(file, header)
+      self._convert(header, raw, params)
+    except WavError as waveError:
+      Log.fatal("Cannot parse input file: " + filename + " (" + waveError.args[0] + ")")
+    except OSError as notFound:
+      Log.fatal(notFound.args[1] + ": " + filename)
+
+  # A wav file from a file name, a binary file object or a buffer (bytes,
+  # bytearray, memoryview, mmap).  Files are memory-mapped if possible, and
+  # buffers aren't copied
+  @classmethod
+  def fromSource(cls, source, params):
+    if isinstance(source, (str, os.PathLike)):
+      return cls(source, params)
+    if hasattr(source, 'read'):
+      try:
+        source = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+      except (OSError, ValueError, AttributeError):
+        source = source.read()  # not a regular file, or an empty one
+    buffer  = memoryview(source).cast('B')
+    wavFile = cls.__new__(cls)
+    try:
+      header = WavHeader(BufferFile(buffer))
+      wavFile._convert(header, buffer[header.dataOffset:header.dataOffset + header.nFrames*header.blockAlign],
+                       params)
+    except WavError as waveError:
+      Log.fatal("Cannot parse input (" + waveError.args[0] + ")")
+    return wavFile
+
+  def _convert(self, header, raw, params):
+    converter = FrameConverter(header, params.channel)
+    converter.probe(raw[0:round(Config.channelProbe*header.frameRate)*header.blockAlign])
+    self.frames    = converter.convert(raw)
+    self.frameRate = header.frameRate
+    self.channel   = converter.channel
+    self.channels  = header.channels
+
+# Read access to a buffer like to a file, without copying the buffer.  Used
+# for parsing the header of a wav file in memory
+class BufferFile:
+  def __init__(self, buffer):
+    self.buffer = buffer
+    self.pos    = 0
+
+  def read(self, n):
+    data = bytes(self.buffer[self.pos:self.pos + n])
+    self.pos += len(data)
+    return data
+
+  def seek(self, offset, whence = os.SEEK_SET):
+    if whence == os.SEEK_CUR:
+      offset += self.pos
+    elif whence == os.SEEK_END:
+      offset += len(self.buffer)
+    self.pos = offset
+    return self.pos
+
+  def tell(self):
+    return self.pos
+
+# Index of all zero crossings in a frame buffer.  Built once per buffer with
+# numpy, and queried with binary search.  A query gives the same result as
+# scanning the frames with WavData._getNextZeroCross.  The crossings are kept
+# as compact arrays: the positions, their directions, and the peak amplitude
+# of the half cycle before each of them.  Other amplitudes are computed from
+# the frames when asked for, so the index doesn't keep a view of them
+class ZeroCrossings:
+  def __init__(self, frames):
+    samples      = np.frombuffer(frames, dtype=np.uint8)
+    positionType = self._positionType(len(samples))
+    positions    = [np.zeros(0, dtype=positionType)]
+    directions   = [np.zeros(0, dtype=np.int8)]
+    # the crossings are found Config.crossingBatch frames at a time, so the
+    # temporary arrays stay small next to the frames
+    for first in range(0, len(samples) - 1, Config.crossingBatch):
+      prev  = samples[first:first + Config.crossingBatch]
+      cur   = samples[first + 1:first + Config.crossingBatch + 1]
+      prev  = prev[:len(cur)]
+      down  = (prev > 0x80) & (cur <= 0x80)
+      up    = (prev < 0x80) & (cur >= 0x80)
+      found = np.flatnonzero(down | up)
+      positions.append((found + first + 1).astype(positionType))
+      directions.append(np.where(down[found], crossDown, crossUp).astype(np.int8))
+    self.frames     = frames
+    self.positions  = np.concatenate(positions)
+    self.directions = np.concatenate(directions)
+    self.peaks      = np.zeros(len(self.positions), dtype=np.int16)
+    for first in range(1, len(self.positions), Config.crossingBatch):
+      ends   = self.positions[first:first + Config.crossingBatch]
+      starts = self.positions[first - 1:first - 1 + len(ends)] + 1
+      self.peaks[first:first + len(ends)] = self.maxAmplitudes(starts, ends)
+    self._candidates = None
+
+  # Restores an index from the arrays returned by toArrays
+  @classmethod
+  def fromArrays(cls, frames, positions, directions, peaks):
+    crossings = cls.__new__(cls)
+    crossings.frames     = frames
+    crossings.positions  = positions
+    crossings.directions = directions
+    crossings.peaks      = peaks
+    crossings._candidates = None
+    return crossings
+
+  @staticmethod
+  def _positionType(numFrames):
+    return np.int32 if numFrames < 2**31 else np.int64
+
+  # The positions, directions and peaks as compact arrays
+  def toArrays(self):
+    return self.positions, self.directions, self.peaks
+
+  # Max amplitude of the frames in each range from starts up to ends, or 0
+  # for an empty range.  The ranges end before the last frame.  The amplitude
+  # is the distance from 0x80, so the max is found from the max and min of
+  # the frames in the range
+  def maxAmplitudes(self, starts, ends):
+    samples = np.frombuffer(self.frames, dtype=np.uint8)
+    starts  = np.asarray(starts, dtype=np.intp)
+    ends    = np.asarray(ends, dtype=np.intp)
+    amplitudes = np.zeros(len(starts), dtype=np.int16)
+    nonEmpty = np.flatnonzero(ends > starts)
+    if len(nonEmpty) > 0:
+      bounds = np.empty(2*len(nonEmpty), dtype=np.intp)
+      bounds[0::2] = starts[nonEmpty]
+      bounds[1::2] = ends[nonEmpty]
+      highs = np.maximum.reduceat(samples, bounds)[0::2].astype(np.int16)
+      lows  = np.minimum.reduceat(samples, bounds)[0::2].astype(np.int16)
+      amplitudes[nonEmpty] = np.maximum(highs - 0x80, 0x80 - lows)
+    return amplitudes
+
+  def __len__(self):
+    return len(self.positions)
+
+  # Index of the first crossing after startFrame
+  def indexAfter(self, startFrame):
+    return int(np.searchsorted(self.positions, startFrame, side='right'))
+
+  # Indexes of the first crossings after each of the startFrames.  The
+  # frames are given the type of the positions, so these aren't copied to
+  # search them
+  def indexesAfter(self, startFrames):
+    startFrames = np.asarray(startFrames).astype(self.positions.dtype)
+    return np.searchsorted(self.positions, startFrames, side='right')
+
+  # Equivalent of WavData._getNextZeroCross(frames, startFrame)
+  def next(self, startFrame):
+    if startFrame == None:
+      return None, None, None
+    ci = self.indexAfter(startFrame)
+    if ci >= len(self.positions):
+      return None, None, None
+    crossIndex = int(self.positions[ci])
+    if ci > 0 and self.positions[ci-1] == startFrame:
+      maxSample = int(self.peaks[ci])
+    elif crossIndex - startFrame > 1:
+      maxSample = int(self.maxAmplitudes([startFrame+1], [crossIndex])[0])
+    else:
+      maxSample = 0
+    return crossIndex, maxSample, int(self.directions[ci])
+
+  # Indexes of the crossings that can begin a start bit with the bit period,
+  # i.e. up crossings after a half cycle peak above Config.minAmplitude,
+  # whose second next crossing is a bit period later, within 30%.  Found
+  # for all the crossings in one pass, and kept for the last bit period
+  def startBitCandidates(self, framesPerBit):
+    if self._candidates == None or self._candidates[0] != framesPerBit:
+      candidates = [np.zeros(0, dtype=np.intp)]
+      for first in range(0, len(self.positions) - 2, Config.crossingBatch):
+        batch = slice(first, min(first + Config.crossingBatch, len(self.positions) - 2))
+        spans = self.positions[batch.start + 2:batch.stop + 2] - self.positions[batch]
+        found = np.flatnonzero((self.directions[batch] == crossUp) & (self.peaks[batch] > Config.minAmplitude) &
+                               (np.abs(spans - framesPerBit) < 0.3*framesPerBit))
+        candidates.append(found + first)
+      self._candidates = (framesPerBit, np.concatenate(candidates))
+    return self._candidates[1]
+
+  # Up to 'count' crossing positions in the open range (startFrame, endFrame)
+  # after each of the startFrames, as a row per start frame.  The positions
+  # after the last one in the range are -1
+  def within(self, startFrames, endFrames, count):
+    first   = self.indexesAfter(startFrames)
+    index   = first[:, None] + np.arange(count)
+    inRange = index < len(self.positions)
+    rows    = self.positions[np.minimum(index, len(self.positions) - 1)].astype(np.int64)
+    inRange &= rows < np.asarray(endFrames, dtype=np.int64)[:, None]
+    return np.where(inRange, rows, -1)
+
+# Moving window filters on unsigned 8 bit frames.  Like the original running
+# sum loops, the first window//2 and the last window//2 + 1 frames are left
+# unfiltered.  All kinds are computed with array operations:
+#   mean:     moving average (cumulative sums)
+#   median:   moving median
+#   bandpass: windowed sinc FIR filter passing the 1200Hz and 2400Hz tones
+#   offset:   subtracts the moving average, i.e. centers the signal on 0x80
+class FrameFilter:
+  noiseFilters = ['mean', 'median', 'bandpass']
+
+  def __init__(self, kind, window, frameRate):
+    self.kind   = kind
+    self.window = window
+    self.half   = window >> 1
+    if kind == 'bandpass':
+      self.taps = self._bandPassTaps(window, frameRate)
+
+  @staticmethod
+  def _bandPassTaps(window, frameRate):
+    t    = np.arange(window) - (window - 1)/2
+    low  = Config.bandPassLow/frameRate
+    high = Config.bandPassHigh/frameRate
+    taps = (2*high*np.sinc(2*high*t) - 2*low*np.sinc(2*low*t))*np.hamming(window)
+    # unity gain between the two tones
+    center = np.sqrt(Config.bandPassLow*Config.bandPassHigh)/frameRate
+    return taps/abs(np.sum(taps*np.exp(-2j*np.pi*center*t)))
+
+  # Filtered values of frames[lo:hi].  frames must be a uint8 array that
+  # includes the window//2 frames before lo and after hi
+  def filterRange(self, frames, lo, hi):
+    half    = self.half
+    segment = frames[lo-half:hi+half]
+    if self.kind in ['mean', 'offset']:
+      sums  = np.cumsum(segment, dtype=np.int64)
+      sums  = sums[self.window-1:] - np.concatenate(([0], sums[:-self.window]))
+      means = np.rint(sums/self.window)
+      if self.kind == 'mean':
+        return means.astype(np.uint8)
+      values = frames[lo:hi] - means + 0x80
+    elif self.kind == 'median':
+      windows = np.lib.stride_tricks.sliding_window_view(segment, self.window)
+      return np.median(windows, axis=1).astype(np.uint8)
+    else:
+      values = np.rint(np.convolve(segment.astype(np.float64) - 0x80, self.taps, 'valid')) + 0x80
+    return np.clip(values, 0, 0xff).astype(np.uint8)
+
+  def apply(self, frames):
+    frames = np.frombuffer(frames, dtype=np.uint8)
+    out    = frames.copy()
+    hi     = len(frames) - self.half - 1
+    if hi > self.half:
+      out[self.half:hi] = self.filterRange(frames, self.half, hi)
+    return memoryview(out)
+
+# Splits the decoded bytes of a tape into its programs while they are
+# decoded.  A program ends with a block with count 0, or before a block with a
+# higher count than the previous one or after a gap of Config.programGap
+# bytes, e.g. the leader of the next program when its last block was lost.
+# Each program is written to the directory as NN-AAAA.cas and NN-AAAA.nas as
+# soon as it ends, and close() writes manifest.json.  The times are those of
+# the first and last byte of a program in the recording
+class TapeSplitter:
+  def __init__(self, directory, decoder):
+    self.directory = directory
+    self.decoder   = decoder
+    self.scanner   = nascas.BlockScanner()
+    self.blocks    = []  # of the current program
+    self.start     = None  # time of the current program
+    self.end       = None
+    self.programs  = []  # manifest entries
+    try:
+      os.makedirs(directory, exist_ok=True)
+    except OSError:
+      Log.fatal("Cannot create directory: " + directory)
+
+  @staticmethod
+  def _blockEnd(block):
+    return block.offset + len(nascas.BlockScanner.marker) + 5 + block.length + 1
+
+  def feed(self, byteValues):
+    for block, headerOk, dataOk in self.scanner.feed(byteValues):
+      if len(self.blocks) > 0:
+        last = self.blocks[-1]
+        if block.count >= last.count or block.offset - self._blockEnd(last) >= Config.programGap:
+          self._endProgram()
+      self.blocks.append(block)
+      if self.start == None:
+        self.start = self.decoder._byteTime(block.offset)
+      self.end = self.decoder._byteTime(self._blockEnd(block) - 1)
+      if block.count == 0:
+        self._endProgram()
+    self.decoder._dropByteTimes(self.scanner.offset)
+
+  def _write(self, name, content):
     try:
-      wf = wave.open(filename, 'rb')
-      wfParams = wf.getparams()
-      self.frames = wf.readframes(wfParams.nframes)
-      self.frameRate = wfParams.framerate
-      wf.close()
-    except Exception as notFound:
-      Log.errorExit(notFound.args[1] + ": " + filename)
-    except wave.Error as waveError:
-      Log.errorExit("Cannot parse input file: " + filename + " (" + waveError.args[0] + ")")
+      with open(os.path.join(self.directory, name), 'wb') as file:
+        file.write(content)
+    except OSError:
+      Log.fatal("Cannot write to output file: " + os.path.join(self.directory, name))
+
+  def _endProgram(self):
+    blocks = self.blocks
+    content = bytearray(nascas.CasFile.FileHeader.encode())
+    for block in blocks:
+      content.extend(block.raw)
+      content.extend(bytes(nascas.CasTape.gap))
+    casFile = nascas.CasTape(content).files[0]
+    name = f'{len(self.programs):02d}-{casFile.startAddress:04X}'
+    self._write(name + '.cas', content)
+    self._write(name + '.nas', nascas.casToNas(content))
+    self.programs.append({
+      'cas':          name + '.cas',
+      'nas':          name + '.nas',
+      'startAddress': f'{casFile.startAddress:04X}',
+      'ranges':       [f'{s:04X}-{e-1:04X}' for s, e in casFile.ranges()],
+      'blocks':       len(blocks),
+      'badBlocks':    [f'{count:02X}' for count in casFile.badBlocks],
+      'complete':     casFile.complete,
+      'start':        round(self.start, 3),
+      'end':          round(self.end, 3),
+    })
+    self.decoder.log.info(f'Program {name}: {len(blocks)} blocks, ' +
+                          f'{len(self.programs[-1]["badBlocks"])} with checksum errors')
+    self.blocks = []
+    self.start  = None
+
+  def close(self):
+    if len(self.blocks) > 0:
+      self._endProgram()
+    try:
+      with open(os.path.join(self.directory, 'manifest.json'), 'w') as manifestFile:
+        json.dump({'programs': self.programs}, manifestFile, indent=2)
+        manifestFile.write('\n')
+    except OSError:
+      Log.fatal("Cannot write to output file: " + os.path.join(self.directory, 'manifest.json'))
+    self.decoder.stats.setCounter('programs', len(self.programs))
 
 class WavData:
-  def __init__(self, wavFile):
+  def __init__(self, wavFile, params):
+    self.params  = params
+    self.log     = Log(params)
     self.wavFile = wavFile
     self.startPositions = None
     self.framesPerBit   = None
     self.frames         = wavFile.frames
+    self.decodedBytes   = None
+    self._crossings     = None
+    self.stats          = DecodeStats()
+    self.tunedOptions   = None  # options picked by auto tuning
+    self.periods        = None  # bit periods of the bytes, with clock recovery
+
+  @property
+  def crossings(self):
+    if self._crossings == None:
+      self._crossings = ZeroCrossings(self.frames)
+    return self._crossings
+
+  def _setFrames(self, frames):
+    self.frames     = frames
+    self._crossings = None
 
   @staticmethod
   def _getNextZeroCross(frames, startFrame):
@@ -201,53 +982,64 @@ class WavData:
       fi += 1
     return None, None, None
 
-  def _getFramesPerBit(self, startSec = 0.0):
-    if Params.framesPerBit == None:
+  def _countHalfBits(self, startSec = 0.0):
+    if self.params.framesPerBit == None:
       expectedFramesPerBit = 2*self.wavFile.frameRate/Config.baseFreq;
     else:
-      expectedFramesPerBit = Params.framesPerBit
+      expectedFramesPerBit = self.params.framesPerBit
     expectedFramesPerHalfBit = expectedFramesPerBit/2
     margin = expectedFramesPerHalfBit/6
     fi = round(startSec * self.wavFile.frameRate)
-    sampleCount    = 0
-    sampleAcc      = 0
-    while True:
-      nextZero, maxSample, _ = self._getNextZeroCross(self.frames, fi)
-      if nextZero == None:
-        break
-      nFrames = nextZero - fi
-      if (abs(nFrames - expectedFramesPerHalfBit) < margin and
-          maxSample > 0x20):
-        sampleCount += 1
-        sampleAcc += nFrames
+    crossings = self.crossings
+    ci = crossings.indexAfter(fi)
+    sampleCount = 0
+    sampleAcc   = 0
+    # Half cycle lengths and peaks from fi and onwards, Config.crossingBatch
+    # crossings at a time.  The first half cycle starts at fi, which doesn't
+    # have to be a crossing
+    for first in range(ci, len(crossings), Config.crossingBatch):
+      ends    = crossings.positions[first:first + Config.crossingBatch].astype(np.int64)
+      lengths = np.diff(ends, prepend=fi)
+      peaks   = crossings.peaks[first:first + Config.crossingBatch].copy()
+      if first == ci:
+        _, peaks[0], _ = crossings.next(fi)
+      qualifying = (np.abs(lengths - expectedFramesPerHalfBit) < margin) & (peaks > 0x20)
+      counted    = np.flatnonzero(qualifying)[:Config.maxSampleCount - sampleCount]
+      sampleCount += len(counted)
+      sampleAcc   += int(lengths[counted].sum())
       if sampleCount >= Config.maxSampleCount:
-        break
-      fi = nextZero
+        # the scan stops at the start of the last qualifying half cycle
+        last = counted[-1]
+        return sampleCount, sampleAcc, fi if last == 0 else int(ends[last-1])
+      fi = int(ends[-1])
+    return sampleCount, sampleAcc, fi
+
+  def _getFramesPerBit(self, startSec = 0.0):
+    sampleCount, sampleAcc, fi = self._countHalfBits(startSec)
+    if sampleCount == 0:
+      Log.fatal("No 1200Hz cycles found to determine the frames per bit")
     framesPerBit   = 2*sampleAcc/sampleCount
     return framesPerBit, sampleCount, fi/self.wavFile.frameRate
 
-  @classmethod
-  def _findNextZeroBit(cls, frames, startFrame, framesPerBit):
-    # find the next 3 zero crossings up->down->up
-
-    fi = startFrame
-    marginBitFrames = 0.3  * framesPerBit
-    marginHalfPoint = 0.3 * framesPerBit
-    while fi != None and fi < len(frames):
-      crossIndex0, maxSample, crossDir = cls._getNextZeroCross(frames, fi)
-      if crossDir == crossUp and maxSample > Config.minAmplitude:
-        crossIndex1, _, _ = cls._getNextZeroCross(frames, crossIndex0)
-        if crossIndex1 == None:
-          return None
-        crossIndex2, _, _ = cls._getNextZeroCross(frames, crossIndex1)
-        if crossIndex2 == None:
-          return None
-        nFrames = crossIndex2 - crossIndex0
-        if (abs(nFrames - framesPerBit) < marginBitFrames):
-#            and abs((crossIndex1 - crossIndex0) - (crossIndex2 - crossIndex1)) < marginHalfPoint):
-          return crossIndex0
-      fi = crossIndex0
-    return None
+  def _findNextZeroBit(self, startFrame, framesPerBit):
+    # find the next 3 zero crossings up->down->up spanning a bit.  Only the
+    # half cycle before the first crossing after startFrame begins at
+    # startFrame; the crossings after it are looked up in the candidates
+    if startFrame == None or startFrame >= len(self.frames):
+      return None
+    crossings = self.crossings
+    positions = crossings.positions
+    ci = crossings.indexAfter(startFrame)
+    if ci + 2 >= len(crossings):
+      return None
+    if (crossings.directions[ci] == crossUp and
+        abs(positions[ci+2] - positions[ci] - framesPerBit) < 0.3*framesPerBit):
+      _, maxSample, _ = crossings.next(startFrame)
+      if maxSample > Config.minAmplitude:
+        return int(positions[ci])
+    candidates = crossings.startBitCandidates(framesPerBit)
+    ki = np.searchsorted(candidates, ci, side='right')
+    return int(positions[candidates[ki]]) if ki < len(candidates) else None
 
   @classmethod
   def _isZero(cls, bitFrames):
@@ -281,27 +1073,17 @@ class WavData:
     else:
       return False
 
-  @classmethod
-  def _isZero3(cls, bitFrames):
-    nFrames = len(bitFrames)
-    margin = 0.1*nFrames
-    crossIndex0, _, _ = cls._getNextZeroCross(bitFrames, 0)
-    if crossIndex0 == None:
-      return True
-    crossIndex1, _, _ = cls._getNextZeroCross(bitFrames, crossIndex0)
-    if crossIndex1 == None:
-      return True
-    crossIndex2, _, _ = cls._getNextZeroCross(bitFrames, crossIndex1)
-    if crossIndex2 == None:
-      return True
-    crossIndex3, _, _ = cls._getNextZeroCross(bitFrames, crossIndex2)
-    if crossIndex3 != None and crossIndex3 - crossIndex2 > margin:
-      return False
-    if (crossIndex1 - crossIndex0) > nFrames/2 - margin:
-      return True
-    if (crossIndex2 - crossIndex1) > nFrames/2 - margin:
-      return True
-    return False
+  # The zero crossing classification of the bit windows: a window is a
+  # 0-bit unless it holds 3 crossings about half a window apart, or a 4th
+  # crossing well after the 3rd
+  def _crossingZeros(self, bitStarts, bitEnds):
+    nFrames  = bitEnds - bitStarts
+    margin   = 0.1*nFrames
+    crossIndexes = self.crossings.within(bitStarts, bitEnds, 4)
+    count    = (crossIndexes >= 0).sum(axis=1)
+    gaps     = np.diff(crossIndexes, axis=1)
+    longGaps = (gaps[:, 0] > nFrames/2 - margin) | (gaps[:, 1] > nFrames/2 - margin)
+    return (count < 3) | (~((count == 4) & (gaps[:, 2] > margin)) & longGaps)
 
   @staticmethod
   def _adjustOffset(bitFrames):
@@ -320,192 +1102,1574 @@ class WavData:
       newBitFrames[bi] = newValue
     return newBitFrames
 
-  @classmethod
-  def _getBits(cls, byteFrames, bitsInByte = None):
-    if bitsInByte == None:
-      bitsInByte = Params.bitsPerByte
-    framesPerBit = len(byteFrames)/bitsInByte;
-    bi = 0
-    bits = ''
+  # Energy of the frames in each bit window at the 0-bit and 1-bit
+  # frequencies, i.e. one and two cycles per bit, computed for all the windows
+  # at once.  Each window is correlated with a sine and a cosine of both
+  # frequencies (a single bin DFT, like the Goertzel algorithm), after
+  # removing the mean of the window.  The windows are padded to the same
+  # width, so the result for a window doesn't depend on the other windows.
+  # Returns the energies at the 0-bit and at the 1-bit frequency
+  def _goertzelEnergies(self, bitStarts, bitEnds):
+    starts  = np.array(bitStarts, dtype=np.int64)
+    lengths = np.maximum(np.array(bitEnds, dtype=np.int64) - starts, 1)
+    width   = int(1.5*self.framesPerBit) + 2
+    offsets = np.arange(width)
+    inside  = offsets < lengths[:, None]
+    frames  = np.frombuffer(self.frames, dtype=np.uint8)
+    index   = np.minimum(starts[:, None] + offsets, len(frames) - 1)
+    samples = np.where(inside, frames[index], 0).astype(np.float64)
+    samples -= (samples.sum(axis=1)/lengths)[:, None]
+    samples *= inside
+    energies = []
+    for cycles in [1, 2]:
+      phase = 2*np.pi*cycles*offsets/self.framesPerBit
+      energies.append((samples*np.cos(phase)).sum(axis=1)**2 + (samples*np.sin(phase)).sum(axis=1)**2)
+    return energies
+
+  # Confidence of the bits in the bit windows, 0 to 255: how strongly the
+  # energies at the 0-bit and 1-bit frequencies favour the bit values in
+  # zeros.  A bit read against the energies has confidence 0
+  def _bitConfidences(self, bitStarts, bitEnds, zeros):
+    zeroEnergy, oneEnergy = self._goertzelEnergies(bitStarts, bitEnds)
+    margins = (zeroEnergy - oneEnergy)/(zeroEnergy + oneEnergy + 1.0)
+    margins = np.where(zeros, margins, -margins)
+    return np.round(255*np.clip(margins, 0.0, 1.0)).astype(np.uint8)
+
+  # Confidences of the bits of the bytes between starts and ends, for the
+  # values in byteValues with a 0 start bit and 1 stop bits.  The bit windows
+  # are placed like _decodeAllBytes does, at the bit periods if given.  A
+  # byte with too many bits to be decoded has confidence 0.  Returns an array
+  # with a row of bitsPerByte confidences per byte
+  def _confidenceRows(self, starts, ends, byteValues, periods = None):
+    params = self.params
+    bitsPerByte = params.bitsPerByte
+    values = np.frombuffer(bytes(byteValues), dtype=np.uint8)
+    bitsInByte, bitStarts, bitEnds = self._byteWindows(starts, ends, periods)
+    # when streaming, the first frames of a byte with too many bits may be gone
+    bitStarts = np.maximum(bitStarts, 0)
+    bitEnds   = np.maximum(bitEnds, 0)
+    zeros = np.zeros((len(starts), bitsPerByte), dtype=bool)
+    zeros[:, 0] = True
+    zeros[:, 1:1+params.dataBits] = (values[:, None] >> np.arange(params.dataBits)) & 1 == 0
+    rows = np.zeros((len(starts), bitsPerByte), dtype=np.uint8)
+    for first in range(0, len(starts), Config.confidenceBatch):
+      batch = slice(first, first + Config.confidenceBatch)
+      rows[batch] = self._bitConfidences(bitStarts[batch].ravel(), bitEnds[batch].ravel(),
+                                         zeros[batch].ravel()).reshape(-1, bitsPerByte)
+    rows[bitsInByte > Config.maxBitsPerByte] = 0
+    return rows
+
+  # Confidences of the bits of the decoded bytes (see _confidenceRows), and
+  # the times of their start bits
+  def confidences(self):
+    numBytes  = len(self.allBytes)
+    positions = self.startPositions
+    rows = self._confidenceRows(positions[:numBytes], positions[1:numBytes+1], self.allBytes, self.periods)
+    return rows, np.array(positions[:numBytes])/self.wavFile.frameRate
+
+  # Writes the confidence of each decoded byte, the lowest of its bits, as
+  # CSV with the time of its start bit and the confidences of its bits
+  def writeConfidence(self, filename):
+    self._writeConfidence(filename, self.allBytes, *self.confidences())
+
+  def _writeConfidence(self, filename, byteValues, rows, times):
+    byteConfidences = rows.min(axis=1, initial=255)
+    lines = ['byte,time,value,confidence,bits\n']
+    for bi, (byteValue, row) in enumerate(zip(byteValues, rows.tolist())):
+      lines.append(f'{bi},{times[bi]:.5f},{byteValue:02X},{byteConfidences[bi]},' +
+                   ' '.join(str(c) for c in row) + '\n')
+    try:
+      with open(filename, 'w') as confidenceFile:
+        confidenceFile.writelines(lines)
+    except OSError:
+      Log.fatal("Cannot write to confidence file: " + filename)
+    weakBytes = int((byteConfidences < Config.weakConfidence).sum())
+    self.log.info(f'Bytes with a bit of confidence below {Config.weakConfidence}: {weakBytes}')
+    self.stats.setCounter('weakBytes', weakBytes)
+
+  # True for the bit windows holding a 0-bit, using the selected engine.
+  # The windows of Config.confidenceBatch bytes are classified at a time,
+  # like the confidences are computed, as both engines take memory per window
+  def _classifyBits(self, bitStarts, bitEnds):
+    bitStarts = np.asarray(bitStarts, dtype=np.int64)
+    bitEnds   = np.asarray(bitEnds, dtype=np.int64)
+    zeros = np.empty(len(bitStarts), dtype=bool)
+    batchSize = Config.confidenceBatch*self.params.bitsPerByte
+    for first in range(0, len(bitStarts), batchSize):
+      batch = slice(first, first + batchSize)
+      if self.params.engine == 'goertzel':
+        zeroEnergy, oneEnergy = self._goertzelEnergies(bitStarts[batch], bitEnds[batch])
+        zeros[batch] = zeroEnergy > oneEnergy
+      else:
+        zeros[batch] = self._crossingZeros(bitStarts[batch], bitEnds[batch])
+    return zeros
+
+  # The bits of a byte from its classified bit windows, as an integer with
+  # the start bit in bit 0 and the stop bit in bit 9
+  @staticmethod
+  def _bitsOf(zeros):
+    return sum(1 << bi for bi, isZero in enumerate(zeros) if not isZero)
+
+  # The bits as text, in the order they were sent
+  @staticmethod
+  def _bitText(bits, bitsInByte):
+    return ''.join('1' if (bits >> bi) & 1 else '0' for bi in range(bitsInByte))
+
+  # Bit positions relative to startFrame, and the frame windows of the bits.
+  # Without a bit period, the bits are spread evenly up to endFrame
+  def _bitWindows(self, startFrame, endFrame, bitsInByte, framesPerBit = None):
+    if framesPerBit == None:
+      framesPerBit = (endFrame - startFrame)/bitsInByte;
     bitPositions = []
+    bitStarts    = []
+    bitEnds      = []
     for bi in range(0, bitsInByte):
       fi = round(bi*framesPerBit)
       bitPositions.append(fi)
-#      if Params.offsetAdjust:
+#      if self.params.offsetAdjust:
 #        bitFrames = cls._adjustOffset(byteFrames[fi:round(fi+framesPerBit)])
 #      else:
-      bitFrames = byteFrames[fi:round(fi+framesPerBit)]
-      if cls._isZero3(bitFrames):
-        bits += '0'
-      else:
-        bits += '1'
-    bitPositions.append(len(byteFrames))
+      bitStarts.append(min(startFrame + fi, endFrame))
+      bitEnds.append(min(startFrame + round(fi+framesPerBit), endFrame))
+    bitPositions.append(endFrame - startFrame)
+    return bitPositions, bitStarts, bitEnds
+
+  # The first bitsPerByte bit windows of each byte between starts and ends,
+  # placed like _bitWindows does for all the bytes at once.  Returns the
+  # number of bits of the bytes, capped at one more than can be decoded, and
+  # the starts and ends of the windows, a row per byte
+  def _byteWindows(self, starts, ends, periods = None):
+    bitsPerByte = self.params.bitsPerByte
+    starts  = np.array(starts, dtype=np.int64)
+    ends    = np.array(ends, dtype=np.int64)
+    nFrames = ends - starts
+    bitsInByte = np.full(len(starts), bitsPerByte, dtype=np.int64)
+    if periods == None:
+      # vectorized _getNumBitsInByte
+      framesPerBit = self.framesPerBit
+      for _ in range(bitsPerByte, Config.maxBitsPerByte + 1):
+        more = bitsInByte*framesPerBit + 0.7*framesPerBit < nFrames
+        if not more.any():
+          break
+        bitsInByte += more
+      periods = nFrames/bitsInByte
+    else:
+      periods = np.array(periods, dtype=np.float64)
+    bitOffsets = np.round(np.arange(bitsPerByte)*periods[:, None])
+    bitStarts  = np.minimum(starts[:, None] + bitOffsets, ends[:, None]).astype(np.int64)
+    bitEnds    = np.minimum(starts[:, None] + np.round(bitOffsets + periods[:, None]),
+                            ends[:, None]).astype(np.int64)
+    return bitsInByte, bitStarts, bitEnds
+
+  # The bits of the byte between two frames (see _bitsOf), and the bit
+  # positions relative to startFrame
+  def _getBits(self, startFrame, endFrame, bitsInByte = None):
+    if bitsInByte == None:
+      bitsInByte = self.params.bitsPerByte
+    bitPositions, bitStarts, bitEnds = self._bitWindows(startFrame, endFrame, bitsInByte)
+    bits = self._bitsOf(self._classifyBits(bitStarts, bitEnds))
     return bits, bitPositions
 
-  @classmethod
-  def _findStartPositions(cls, allFrames, startFrame, framesPerBit):
+  # Single pass clock recovery.  Walks the zero crossings once, finding the
+  # start bits like _findNextZeroBit does with the current bit period.  The
+  # period is tracked with a first order loop on the byte clock: when a start
+  # bit follows the previous byte without a gap, the period moves a fraction
+  # of the way towards the period of that byte.  Returns the start positions
+  # and the bit period of each byte; the bits of a byte without a gap after
+  # it are spread evenly, like the fixed clock does
+  def _recoverClock(self, framesPerBit):
+    crossings   = self.crossings
+    bitsPerByte = self.params.bitsPerByte
     startPositions = []
-    bitPos = startFrame
-    while bitPos < len(allFrames):
-      startPositions.append(bitPos)
-      nextPos = round(bitPos + (1 + Params.dataBits + 0.5)*framesPerBit)
-      bitPos = cls._findNextZeroBit(allFrames, nextPos, framesPerBit)
-      if bitPos == None:
-        break
-    return startPositions
+    periods        = []
+    searchFrom = -1
+    for first in range(0, len(crossings) - 2, Config.crossingBatch):
+      # the loop reads the crossings one at a time, which is faster from
+      # lists, so they're copied to lists Config.crossingBatch at a time
+      last       = min(first + Config.crossingBatch, len(crossings) - 2)
+      positions  = crossings.positions[first:last + 2].tolist()
+      directions = crossings.directions[first:last].tolist()
+      peaks      = crossings.peaks[first:last].tolist()
+      for ci in range(0, last - first):
+        if (positions[ci] > searchFrom and directions[ci] == crossUp and
+            peaks[ci] > Config.minAmplitude and
+            abs(positions[ci+2] - positions[ci] - framesPerBit) < 0.3*framesPerBit):
+          if len(startPositions) > 0:
+            byteFrames = positions[ci] - startPositions[-1]
+            if abs(byteFrames - bitsPerByte*framesPerBit) < Config.pllLockRange*framesPerBit:
+              framesPerBit += Config.pllGain*(byteFrames/bitsPerByte - framesPerBit)
+              periods.append(byteFrames/bitsPerByte)
+            else:
+              periods.append(framesPerBit)
+          startPositions.append(positions[ci])
+          searchFrom = round(positions[ci] + (1 + self.params.dataBits + 0.5)*framesPerBit)
+    return startPositions, periods
+
+  # The start positions from startFrame, each found with _findNextZeroBit
+  # from a byte after the previous one.  Every start bit after the first is
+  # a start bit candidate, so the next start bit after each candidate is
+  # looked up for all of them at once, and the start positions are a walk
+  # over those links
+  def _findStartPositions(self, startFrame, framesPerBit):
+    crossings = self.crossings
+    candidates = crossings.startBitCandidates(framesPerBit)
+    positions  = crossings.positions
+    directions = crossings.directions
+    # the first crossing after the byte of each candidate, as _findNextZeroBit
+    # checks it, with the peak of its half cycle from the end of the byte
+    nextPos = np.round(positions[candidates] + (1 + self.params.dataBits + 0.5)*framesPerBit).astype(np.int64)
+    nextPos = np.minimum(nextPos, len(self.frames))
+    first   = crossings.indexesAfter(nextPos)
+    checked = np.flatnonzero(first + 2 < len(positions))
+    ci      = first[checked]
+    firstOk = ((directions[ci] == crossUp) &
+               (np.abs(positions[ci+2] - positions[ci] - framesPerBit) < 0.3*framesPerBit))
+    checked, ci = checked[firstOk], ci[firstOk]
+    peakStarts = nextPos[checked] + 1
+    peakEnds   = positions[ci]
+    peaks = crossings.maxAmplitudes(peakStarts, peakEnds)
+    links = np.searchsorted(candidates, first, side='right')
+    taken = checked[peaks > Config.minAmplitude]
+    links[taken] = np.searchsorted(candidates, first[taken])
+    links[nextPos >= len(self.frames)] = len(candidates)
+    # the first start bit doesn't have to be a candidate
+    bitPos = self._findNextZeroBit(round(startFrame + (1 + self.params.dataBits + 0.5)*framesPerBit),
+                                   framesPerBit)
+    ki = len(candidates) if bitPos == None else int(np.searchsorted(candidates, crossings.indexAfter(bitPos - 1)))
+    walk = []
+    while ki < len(candidates):
+      walk.append(ki)
+      ki = int(links[ki])
+    return [startFrame] + positions[candidates[walk]].tolist()
 
   @staticmethod
   def _toByte(bits):
-    byteVal = 0
-    bitVal = 1
-    for b in bits[1:9]:
-      if b == '1':
-        byteVal += bitVal
-      bitVal = bitVal << 1
-    return byteVal
+    return (bits >> 1) & 0xff
 
   def _timeStampOf(self, frameNum):
     return frameNum/self.wavFile.frameRate
 
-  def _getNumBitsInByte(self, frames):
-    numBits = Params.bitsPerByte
-    while numBits*self.framesPerBit + 0.7*self.framesPerBit < len(frames):
+  # Time of the start bit of a decoded byte
+  def _byteTime(self, byteNum):
+    return self._timeStampOf(self.startPositions[byteNum])
+
+  # Called when the times of the bytes before byteNum are no longer needed
+  def _dropByteTimes(self, byteNum):
+    pass
+
+  # The TapeSplitter for the output, if the tape is split into its programs
+  def _splitter(self):
+    if self.params.splitDir == None:
+      return None
+    return TapeSplitter(self.params.splitDir, self)
+
+  def _getNumBitsInByte(self, nFrames):
+    numBits = self.params.bitsPerByte
+    while numBits*self.framesPerBit + 0.7*self.framesPerBit < nFrames:
       numBits += 1
     return numBits
     
+  # Returns the number of bits and the bits of the byte between two start
+  # positions (see _bitsOf).  Only the bits up to the stop bits are
+  # classified, as the rest isn't used.  The bits are None when the byte is
+  # too long to be decoded
+  def _decodeByte(self, bpStart, bpEnd):
+    bitsInByte = self._getNumBitsInByte(bpEnd - bpStart)
+    if bitsInByte > Config.maxBitsPerByte:
+      return bitsInByte, None
+    bitsPerByte = self.params.bitsPerByte
+    _, bitStarts, bitEnds = self._bitWindows(bpStart, bpEnd, bitsInByte)
+    return bitsInByte, self._bitsOf(self._classifyBits(bitStarts[:bitsPerByte], bitEnds[:bitsPerByte]))
+
+  # Reports the framing errors of byte spi, starting at frame startFrame,
+  # and returns its value.  A byte with too many bits has the value 0
+  def _checkByte(self, spi, startFrame, bitsInByte, bits):
+    if bits == None:
+      self.log.error(f'Too many bits at byte: {spi} ({bitsInByte})')
+      self.stats.framingError('tooManyBits', spi, self._timeStampOf(startFrame))
+      bits = 1 << 9
+    if bits & 1 != 0:
+      self.log.error(f'Start-bit is not zero at byte: {spi}')
+      self.stats.framingError('startBit', spi, self._timeStampOf(startFrame))
+    if (bits >> 9) & 1 != 1:
+      self.log.error(f'Stop-bit is not one at byte: {spi}')
+      self.stats.framingError('stopBit', spi, self._timeStampOf(startFrame))
+    return self._toByte(bits)
+
+  # Decodes the bytes between the start positions, like _decodeByte, for all
+  # the bytes at once.  The bit windows of the bytes are placed and
+  # classified in one batch.  With the bit periods of the bytes (from
+  # _recoverClock), the bits are placed at those periods from the start bit
+  # instead, and no byte has too many bits.  Returns an array of the number
+  # of bits of the bytes and an array of their bits.  The bits of a byte
+  # with too many bits are -1
+  def _decodeAllBytes(self, startPositions, periods = None):
+    bitCounts, bitStarts, bitEnds = self._byteWindows(startPositions[:-1], startPositions[1:], periods)
+    decodable = bitCounts <= Config.maxBitsPerByte
+    for spi in np.flatnonzero(~decodable).tolist():
+      bitCounts[spi] = self._getNumBitsInByte(startPositions[spi+1] - startPositions[spi])
+    zeros = self._classifyBits(bitStarts[decodable].ravel(), bitEnds[decodable].ravel())
+    ones  = ~zeros.reshape(-1, self.params.bitsPerByte)
+    bitValues = np.full(len(bitCounts), -1, dtype=np.int64)
+    bitValues[decodable] = ones @ (1 << np.arange(self.params.bitsPerByte, dtype=np.int64))
+    return bitCounts, bitValues
+
+  # The values of the decoded bytes, in a buffer allocated for all of them.
+  # The framing is checked for all the bytes at once, and only the bytes with
+  # framing errors are reported one by one
   def _convertToBytes(self, expectedFramesPerByte):
-    byteValues = bytearray()
-    for spi in range(0, len(self.startPositions)-1):
-      bpStart = self.startPositions[spi]
-      bpEnd   = self.startPositions[spi+1]
-      byteFrames = self.frames[self.startPositions[spi]:self.startPositions[spi+1]]
-      bitsInByte = self._getNumBitsInByte(byteFrames)
-      if bitsInByte > Config.maxBitsPerByte:
-        Log.error(f'Too many bits at byte: {spi} ({bitsInByte})')
-        bits = '0000000001'
-      else:
-        bits, _ = self._getBits(byteFrames, bitsInByte)
-      if bits[0] != '0':
-        Log.error(f'Start-bit is not zero at byte: {spi}')
-      if bits[9] != '1':
-        Log.error(f'Stop-bit is not one at byte: {spi}')
-      byteValues.append(self._toByte(bits))
+    if self.decodedBytes == None:
+      self.decodedBytes = self._decodeAllBytes(self.startPositions)
+    bitCounts, bitValues = self.decodedBytes
+    byteValues = bytearray(len(bitValues))
+    np.frombuffer(byteValues, dtype=np.uint8)[:] = self._toByte(np.maximum(bitValues, 0))
+    framingErrors = (bitValues < 0) | (bitValues & 1 != 0) | ((bitValues >> 9) & 1 != 1)
+    for spi in np.flatnonzero(framingErrors).tolist():
+      bits = int(bitValues[spi])
+      self._checkByte(spi, self.startPositions[spi], int(bitCounts[spi]), None if bits < 0 else bits)
     return byteValues
 
+  # Coarse scan for the '00 .. 00 FF FF FF FF' sequences NAS-SYS writes
+  # between blocks, i.e. a run of mostly 1200Hz cycles followed by a run of
+  # mostly 2400Hz cycles.  Returns the frames where the 2400Hz runs begin
+  def _findBlockMarkers(self):
+    positions = self.crossings.positions.astype(np.int64)
+    window    = 4*self.params.bitsPerByte
+    if len(positions) < 3:
+      return []
+    isLong    = np.diff(positions) > 0.375*self.framesPerBit
+    grid      = np.arange(positions[0], positions[-1], self.framesPerBit)
+    if len(grid) <= 2*window:
+      return []
+    halfCycle = np.minimum(np.searchsorted(positions, grid, side='right') - 1, len(isLong) - 1)
+    zeroBits  = np.concatenate(([0], np.cumsum(isLong[halfCycle])))
+    before    = (zeroBits[window:-window] - zeroBits[:-2*window])/window
+    after     = (zeroBits[2*window:] - zeroBits[window:-window])/window
+    isMarker  = (before >= 0.8) & (after <= 0.2)
+    firsts    = np.flatnonzero(isMarker & ~np.concatenate(([False], isMarker[:-1])))
+    return grid[firsts + window].astype(np.int64).tolist()
+
+  # Splits the frames in about 'jobs' segments, starting just before block
+  # markers
+  def _segmentStarts(self, jobs):
+    markers = self._findBlockMarkers()
+    starts  = [0]
+    for si in range(1, jobs):
+      if len(markers) == 0:
+        break
+      target = len(self.frames)*si/jobs
+      mi = bisect.bisect_left(markers, target)
+      closest = min(markers[max(0, mi-1):mi+1], key=lambda m: abs(m - target))
+      start = max(0, round(closest - self.framesPerBit))
+      if start > starts[-1]:
+        starts.append(start)
+    return starts
+
+  # Parallel version of _findStartPositions.  Each segment is decoded from its
+  # beginning and a bit into the next segment.  The start positions only
+  # depend on the previous start position, so once the decoding of two
+  # segments meets in the same start position, the rest of the positions are
+  # the same, and the segments are joined there.  This gives the same result
+  # as the serial version.  The bits of the bytes are decoded as well, and
+  # stored in self.decodedBytes.  The frames are copied to shared memory
+  # once, and the workers decode their segments from there
+  def _findStartPositionsParallel(self, framesPerBit, jobs):
+    segmentStarts = self._segmentStarts(jobs)
+    overlap = round(Config.segmentOverlap*self.params.bitsPerByte*framesPerBit)
+    segments = []
+    for si, start in enumerate(segmentStarts):
+      end = len(self.frames)
+      if si + 1 < len(segmentStarts):
+        end = min(end, segmentStarts[si+1] + overlap)
+      segments.append((start, end))
+    self.log.verbose(f'Decoding {len(segments)} segments in parallel')
+    self.stats.setCounter('segments', len(segments))
+    frames = self.frames
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(frames)))
+    try:
+      shm.buf[:len(frames)] = frames
+      with concurrent.futures.ProcessPoolExecutor(
+          max_workers=min(jobs, len(segments)), initializer=_attachSharedWavFile,
+          initargs=(shm.name, len(frames), self.wavFile.frameRate,
+                    self.wavFile.channel, self.wavFile.channels)) as pool:
+        chains = list(pool.map(_decodeSegment, segments,
+                               itertools.repeat(framesPerBit), itertools.repeat(self.params)))
+    finally:
+      shm.close()
+      shm.unlink()
+    positions, bitCounts, bitValues = chains[0]
+    ended = False
+    for si in range(1, len(chains)):
+      if ended:
+        break
+      nextPositions, nextCounts, nextValues = chains[si]
+      index = {p: i for i, p in enumerate(nextPositions)}
+      pi = bisect.bisect_left(positions, segmentStarts[si])
+      while True:
+        while pi < len(positions) and positions[pi] not in index:
+          pi += 1
+        if pi < len(positions):
+          ni = index[positions[pi]]
+          positions = positions[:pi] + nextPositions[ni:]
+          bitCounts = bitCounts[:pi] + nextCounts[ni:]
+          bitValues = bitValues[:pi] + nextValues[ni:]
+          break
+        # the segments didn't meet within the overlap; continue serially
+        nextPos = round(positions[-1] + (1 + self.params.dataBits + 0.5)*framesPerBit)
+        bitPos  = self._findNextZeroBit(nextPos, framesPerBit)
+        if bitPos == None:
+          ended = True
+          break
+        bitsInByte, bits = self._decodeByte(positions[-1], bitPos)
+        bitCounts.append(bitsInByte)
+        bitValues.append(-1 if bits == None else bits)
+        positions.append(bitPos)
+    self.decodedBytes = (np.array(bitCounts, dtype=np.int64), np.array(bitValues, dtype=np.int64))
+    return positions
+
+  # matplotlib is only imported when plotting, so it isn't needed otherwise
   @staticmethod
   def plotByteFrames(frames, bitPositions):
-    fig, ax = plt.subplots(1, 1, figsize=(10,5))
-    plt.grid(visible=True, which='both', axis='both')
-    intFrames = [int(v)-0x80 for v in frames]
-    ax.set_xticks(bitPositions)
-    plt.plot(intFrames)
-    plt.show()
+    try:
+      import wavplot
+    except ImportError as importError:
+      Log.fatal("Plotting requires matplotlib (" + str(importError) + ")")
+    wavplot.plotByteFrames(frames, bitPositions)
 
   def plotByte(self, byteNum):
     if byteNum >= len(self.startPositions):
-      Log.errorExit("Cannot plot beyond number of bytes available")
+      Log.fatal("Cannot plot beyond number of bytes available")
     startFrame = self.startPositions[byteNum]
     if byteNum+1 >= len(self.startPositions):
       endFrame = len(self.frames)
     else:
       endFrame = self.startPositions[byteNum+1]
     byteFrames = self.frames[startFrame:endFrame]
-    bits, bitPositions = self._getBits(byteFrames, self._getNumBitsInByte(byteFrames))
-#    if Params.offsetAdjust:
+    bits, bitPositions = self._getBits(startFrame, endFrame, self._getNumBitsInByte(len(byteFrames)))
+#    if self.params.offsetAdjust:
 #      newByteFrames = bytearray()
 #      for bi in range(1, len(bitPositions)):
 #        newByteFrames.extend(self._adjustOffset(byteFrames[bitPositions[bi-1]:bitPositions[bi]]))
 #      byteFrames = newByteFrames
     byteVal = self._toByte(bits)
     secs    = self._timeStampOf(startFrame)
-    Log.info(f'{byteNum:04X}: {bits} {byteVal:02X}, sampled at: {secs:.5f}s')
-    if Params.verbose:
+    self.log.info(f'{byteNum:04X}: {self._bitText(bits, len(bitPositions) - 1)} {byteVal:02X}, ' +
+                  f'sampled at: {secs:.5f}s')
+    if self.params.verbose:
       for bi in range(1, len(bitPositions)):
         fvals = [f'{fv:02X}' for fv in byteFrames[bitPositions[bi-1]:bitPositions[bi]]]
-        Log.info(f'bit: {bi-1} : {fvals}')
+        self.log.info(f'bit: {bi-1} : {fvals}')
     self.plotByteFrames(byteFrames, bitPositions)
 
   def _reduceNoise(self):
-    nFrames = len(self.wavFile.frames)
-    self.frames = bytearray(nFrames)
-    value = 0
-    noiseWindowHalf = Params.noiseWindow >> 1
-    for fi in range(0, noiseWindowHalf):
-      self.frames[fi] = self.wavFile.frames[fi]
-    for ni in range(0, Params.noiseWindow):
-      value += self.wavFile.frames[ni]
-    for fi in range(noiseWindowHalf, nFrames - noiseWindowHalf - 1):
-      self.frames[fi] = round(value/Params.noiseWindow)
-      value = value + self.wavFile.frames[fi+noiseWindowHalf+1] - self.wavFile.frames[fi-noiseWindowHalf]
-    for fi in range(nFrames - noiseWindowHalf - 1, nFrames):
-      self.frames[fi] = self.wavFile.frames[fi]
+    noiseFilter = FrameFilter(self.params.noiseFilter, self.params.noiseWindow, self.wavFile.frameRate)
+    self._setFrames(noiseFilter.apply(self.wavFile.frames))
 
   def _adjustOffsetAll(self):
-    nFrames = len(self.frames)
-    newFrames = bytearray(nFrames)
-    offsetWindow = round(self.framesPerBit)
-    offsetWindow = offsetWindow | 1
-    offsetWindowHalf = offsetWindow >> 1
-    value = 0
-    for fi in range(0, offsetWindowHalf):
-      newFrames[fi] = self.frames[fi]
-    for fi in range(0, offsetWindow):
-      value += self.frames[fi]
-    for fi in range(offsetWindowHalf, nFrames - offsetWindowHalf - 1):
-      newValue = self.frames[fi] - round(value/offsetWindow) + 0x80
-      if newValue < 0: newValue = 0
-      if newValue > 0xff: newValue = 0xff
-      newFrames[fi] = newValue
-      value = value + self.frames[fi+offsetWindowHalf+1] - self.frames[fi-offsetWindowHalf]
-    for fi in range(nFrames - offsetWindowHalf - 1, nFrames):
-      newFrames[fi] = self.frames[fi]
-    self.frames = newFrames
+    offsetWindow = round(self.framesPerBit) | 1
+    offsetFilter = FrameFilter('offset', offsetWindow, self.wavFile.frameRate)
+    self._setFrames(offsetFilter.apply(self.frames))
+
+  def _logChannel(self):
+    if self.wavFile.channels > 1:
+      self.log.info(f'Decoding channel {self.wavFile.channel} of {self.wavFile.channels}')
 
+  # Decodes the frames to self.allBytes.  Returns the stats of the decoding
   def process(self):
-    if Params.noiseWindow != None:
-      Log.progress('Reducing noise')
-      self._reduceNoise()
-    Log.progress('Determining frames per bit')
-    framesPerBit, sampleCount, sampleTime = self._getFramesPerBit()
+    stats = self.stats
+    self._logChannel()
+    if self.params.noiseWindow != None:
+      self.log.progress('Reducing noise')
+      with stats.stage('noiseReduction'):
+        self._reduceNoise()
+    pll = self.params.clock == 'pll'
+    with stats.stage('crossingIndex'):
+      self.crossings
+    if pll:
+      # the clock recovery starts from the expected frames per bit
+      framesPerBit = self.params.framesPerBit
+      if framesPerBit == None:
+        framesPerBit = 2*self.wavFile.frameRate/Config.baseFreq
+    else:
+      self.log.progress('Determining frames per bit')
+      with stats.stage('framesPerBit'):
+        framesPerBit, sampleCount, sampleTime = self._getFramesPerBit()
+      self.log.info(f'Frames per bit after {sampleCount} samples: {framesPerBit:.4f}. ' +
+              f'Last sample at: {sampleTime:.5f}s. ' +
+              f'Real baud rate: {int(self.wavFile.frameRate/framesPerBit)}.')
     self.framesPerBit = framesPerBit
-    Log.info(f'Frames per bit after {sampleCount} samples: {framesPerBit:.4f}. ' +
-            f'Last sample at: {sampleTime:.5f}s. ' +
-            f'Real baud rate: {int(self.wavFile.frameRate/framesPerBit)}.')
-    if Params.offsetAdjust:
-      Log.progress('Offsetting frames')
-      self._adjustOffsetAll()
+    if self.params.offsetAdjust:
+      self.log.progress('Offsetting frames')
+      with stats.stage('offsetAdjust'):
+        self._adjustOffsetAll()
+      with stats.stage('crossingIndex'):
+        self.crossings
 
-    firstStartBit = self._findNextZeroBit(self.frames, 0, framesPerBit)
-    Log.progress("Finding all start bits")
-    startPositions = self._findStartPositions(self.frames, firstStartBit, framesPerBit)
+    self.log.progress("Finding all start bits")
+    with stats.stage('startBitSearch'):
+      if pll:
+        startPositions, periods = self._recoverClock(framesPerBit)
+        if len(startPositions) == 0:
+          Log.fatal("No start bits found")
+        firstStartBit = startPositions[0]
+      else:
+        firstStartBit = self._findNextZeroBit(0, framesPerBit)
+        startPositions = None
+        if self.params.jobs != None and self.params.jobs > 1:
+          startPositions = self._findStartPositionsParallel(framesPerBit, self.params.jobs)
+        if startPositions == None or len(startPositions) == 0:
+          self.decodedBytes = None
+          startPositions = self._findStartPositions(firstStartBit, framesPerBit)
     self.startPositions = startPositions
     lastStartBit = startPositions[-1]
-    Log.info(f'Found {len(startPositions)} start bits, ' +
+    self.log.info(f'Found {len(startPositions)} start bits, ' +
              f'First: {self._timeStampOf(firstStartBit):.5f}s, ' +
              f'Last: {self._timeStampOf(lastStartBit):.5f}s')
-    expectedFramesPerByte = framesPerBit*Params.bitsPerByte
-    Log.progress('Converting bits to bytes')
-    self.allBytes = self._convertToBytes(expectedFramesPerByte)
-    Log.info(f'Number of bytes: {len(self.allBytes)}')
+    if pll:
+      framesPerBit = sum(periods)/len(periods)
+      self.framesPerBit = framesPerBit
+      self.periods      = periods
+      self.log.info(f'Frames per bit tracked from {min(periods):.4f} to {max(periods):.4f}, ' +
+              f'average: {framesPerBit:.4f}')
+    expectedFramesPerByte = framesPerBit*self.params.bitsPerByte
+    self.log.progress('Converting bits to bytes')
+    with stats.stage('byteConversion'):
+      if pll:
+        self.decodedBytes = self._decodeAllBytes(startPositions, periods)
+      self.allBytes = self._convertToBytes(expectedFramesPerByte)
+    self.numBytes = len(self.allBytes)
+    self.log.info(f'Number of bytes: {self.numBytes}')
+    stats.setCounter('frames', len(self.frames))
+    stats.setCounter('audioSeconds', self._timeStampOf(len(self.frames)))
+    stats.setCounter('crossings', len(self.crossings))
+    stats.setCounter('framesPerBit', framesPerBit)
+    if pll:
+      stats.setCounter('framesPerBitMin', min(periods))
+      stats.setCounter('framesPerBitMax', max(periods))
+    else:
+      stats.setCounter('framesPerBitSamples', sampleCount)
+    stats.setCounter('startBits', len(startPositions))
+    stats.setCounter('bytes', self.numBytes)
+    return stats
 
   def writeToFile(self, filename):
     try:
-      casFile = open(Params.outputFilename, "wb")
+      casFile = open(filename, "wb")
     except:
-      Log.errorExit("Cannot write to output file: " + filename)
+      Log.fatal("Cannot write to output file: " + filename)
     else:
       casFile.write(self.allBytes)
       casFile.close()
+    splitter = self._splitter()
+    if splitter != None:
+      splitter.feed(self.allBytes)
+      splitter.close()
+
+# Decodes one segment of the shared frames.  Runs in a worker process
+def _decodeSegment(segment, framesPerBit, params):
+  start, end = segment
+  return SegmentDecoder(_sharedWavFile.frames[start:end], start, framesPerBit, params).decode()
+
+# Decodes the start positions and bytes of a segment of the frames.
+# Positions are frame numbers in the whole recording
+class SegmentDecoder(WavData):
+  def __init__(self, frames, base, framesPerBit, params):
+    self.params         = params
+    self.log            = Log(params)
+    self.wavFile        = None
+    self.startPositions = None
+    self.framesPerBit   = framesPerBit
+    self.frames         = frames
+    self.decodedBytes   = None
+    self._crossings     = None
+    self.stats          = DecodeStats()
+    self.base           = base
+
+  # Returns the start positions from startFrame in the segment, and the
+  # number of bits and the bits of the bytes between them (see
+  # _decodeAllBytes), as lists
+  def decode(self, startFrame = 0):
+    found = self._findNextZeroBit(startFrame, self.framesPerBit)
+    if found == None:
+      return [], [], []
+    positions = self._findStartPositions(found, self.framesPerBit)
+    bitCounts, bitValues = self._decodeAllBytes(positions)
+    return [p + self.base for p in positions], bitCounts.tolist(), bitValues.tolist()
+
+# The converted frames of a wav file in shared memory, as attached by an auto
+# tuning or segment decoding worker.  Has the WavFile attributes used by WavData
+class SharedWavFile:
+  def __init__(self, name, numFrames, frameRate, channel, channels):
+    self.shm       = shared_memory.SharedMemory(name=name)
+    self.frames    = self.shm.buf[:numFrames]
+    self.frameRate = frameRate
+    self.channel   = channel
+    self.channels  = channels
+
+_sharedWavFile = None
+
+# Initializer of the auto tuning and segment decoding worker processes
+def _attachSharedWavFile(name, numFrames, frameRate, channel, channels):
+  global _sharedWavFile
+  _sharedWavFile = SharedWavFile(name, numFrames, frameRate, channel, channels)
+
+# Decodes the shared frames with one parameter set.  Runs in a worker process
+def _tuneCandidate(options, params):
+  return AutoTuner.score(_sharedWavFile, AutoTuner.candidateParams(params, options), options)
+
+# Decodes a recording with a grid of parameter sets in parallel, and picks the
+# one giving the most NAS-SYS blocks with a valid checksum, then the fewest
+# blocks with checksum errors, then the fewest framing errors.  The frames
+# are copied to shared memory once, and used from there by the workers
+class AutoTuner:
+  noiseOptions   = [(None, 'mean'), (3, 'mean'), (5, 'mean'), (71, 'bandpass')]
+  offsetOptions  = [False, True]
+  stopBitOptions = [1, 2]
+
+  def __init__(self, wavFile, params):
+    self.wavFile = wavFile
+    self.params  = params
+    self.log     = Log(params)
+    self.results = None  # scores of all parameter sets, best first
+
+  # The parameter sets to try.  The bandpass filter length is for 44.1kHz,
+  # and is scaled to the frame rate
+  def candidates(self):
+    candidates = []
+    for noiseWindow, noiseFilter in self.noiseOptions:
+      if noiseFilter == 'bandpass':
+        noiseWindow = round(noiseWindow*self.wavFile.frameRate/44100) | 1
+      for offsetAdjust in self.offsetOptions:
+        for stopBits in self.stopBitOptions:
+          candidates.append({'noiseWindow': noiseWindow, 'noiseFilter': noiseFilter,
+                             'offsetAdjust': offsetAdjust, 'stopBits': stopBits})
+    return candidates
+
+  @staticmethod
+  def candidateParams(params, options):
+    candidate = copy.copy(params)
+    for name, value in options.items():
+      setattr(candidate, name, value)
+    candidate.bitsPerByte = 1 + candidate.dataBits + candidate.stopBits
+    candidate.silent      = True
+    candidate.printErrors = False
+    candidate.verbose     = False
+    candidate.jobs        = None
+    candidate.autoTune    = False
+    return candidate
+
+  # The options of a parameter set as wavcas.py arguments
+  @staticmethod
+  def optionText(options):
+    args = []
+    if options['noiseWindow'] != None:
+      if options['noiseFilter'] != 'mean':
+        args.append('-k ' + options['noiseFilter'])
+      args.append(f'-n {options["noiseWindow"]}')
+    if options['offsetAdjust']:
+      args.append('-o')
+    if options['stopBits'] != 1:
+      args.append(f'-t {options["stopBits"]}')
+    return ' '.join(args)
+
+  # Decodes with one parameter set and checks the NAS-SYS blocks of the
+  # result, like nascas.py does
+  @staticmethod
+  def score(wavFile, params, options):
+    result = {'options': options, 'goodBlocks': -1, 'badBlocks': 0, 'framingErrors': 0, 'bytes': 0}
+    try:
+      wd = WavData(wavFile, params)
+      wd.process()
+      inputData = nascas.InputData(printErrors = False)
+      try:
+        inputData.initWithCasData(wd.allBytes)
+      except nascas.NasError:
+        pass  # the last block is cut short
+    except Exception:
+      return result
+    result['goodBlocks']    = inputData.numBlocks - len(inputData.badBlocks)
+    result['badBlocks']     = len(inputData.badBlocks)
+    result['framingErrors'] = sum(wd.stats.counters[kind + 'Errors'] for kind in DecodeStats.framingErrorKinds)
+    result['bytes']         = wd.numBytes
+    return result
+
+  @staticmethod
+  def _rank(result):
+    return (-result['goodBlocks'], result['badBlocks'], result['framingErrors'])
+
+  # Returns the params of the best parameter set.  The scores of all sets
+  # are kept in self.results
+  def tune(self):
+    candidates = self.candidates()
+    workers = self.params.jobs if self.params.jobs != None else os.cpu_count()
+    self.log.progress(f'Auto tuning {len(candidates)} parameter sets with {workers} processes')
+    frames = self.wavFile.frames
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(frames)))
+    try:
+      shm.buf[:len(frames)] = frames
+      with concurrent.futures.ProcessPoolExecutor(
+          max_workers=workers, initializer=_attachSharedWavFile,
+          initargs=(shm.name, len(frames), self.wavFile.frameRate,
+                    self.wavFile.channel, self.wavFile.channels)) as pool:
+        results = list(pool.map(_tuneCandidate, candidates, itertools.repeat(self.params)))
+    finally:
+      shm.close()
+      shm.unlink()
+    self.results = sorted(results, key=self._rank)
+    for result in self.results:
+      text = self.optionText(result['options']) or '(none)'
+      if result['goodBlocks'] < 0:
+        self.log.verbose(f'  {text:20} decoding failed')
+      else:
+        self.log.verbose(f'  {text:20} blocks: {result["goodBlocks"]} ok, {result["badBlocks"]} bad, ' +
+                         f'framing errors: {result["framingErrors"]}')
+    best = self.results[0]
+    self.log.info('Best parameters: ' + (self.optionText(best['options']) or '(none)'))
+    bestParams = self.candidateParams(self.params, best['options'])
+    bestParams.silent      = self.params.silent
+    bestParams.printErrors = self.params.printErrors
+    bestParams.verbose     = self.params.verbose
+    return bestParams
+
+# Re-decodes the NAS-SYS blocks with a header or data checksum error after a
+# decoding.  Only the frames of a damaged block, from its start positions,
+# are decoded again, with the other noise reduction and offset options, the
+# other bit classifier and slightly off bit periods, until a variant gives
+# the block with valid checksums.  As a last resort, the weakest bits of the
+# block, those with the lowest confidence (see WavData._confidenceRows),
+# are flipped until the data checksum matches.  That is only tried for a
+# block without framing errors, and with few bits, as a one byte checksum
+# matches one in 256 wrong guesses.  A repaired block replaces the damaged
+# one in allBytes and startPositions
+class BlockRepairer:
+  contextBytes = 2  # decoded around a block for the filters and start bits
+  flipBits     = 4  # weakest bits tried flipped, alone and in pairs
+
+  def __init__(self, decoder):
+    self.decoder = decoder
+    self.params  = decoder.params
+    self.log     = decoder.log
+
+  # The options of the variants to try, with a bit period scale
+  def variants(self):
+    params  = self.params
+    base    = {'noiseWindow': params.noiseWindow, 'noiseFilter': params.noiseFilter,
+               'offsetAdjust': params.offsetAdjust, 'stopBits': params.stopBits, 'engine': params.engine}
+    current = (params.noiseWindow, params.noiseFilter if params.noiseWindow != None else None,
+               params.offsetAdjust)
+    variants = []
+    for noiseWindow, noiseFilter in AutoTuner.noiseOptions:
+      if noiseFilter == 'bandpass':
+        noiseWindow = round(noiseWindow*self.decoder.wavFile.frameRate/44100) | 1
+      for offsetAdjust in AutoTuner.offsetOptions:
+        if (noiseWindow, noiseFilter if noiseWindow != None else None, offsetAdjust) != current:
+          variants.append((dict(base, noiseWindow=noiseWindow, noiseFilter=noiseFilter,
+                                offsetAdjust=offsetAdjust), 1.0))
+    for engine in Config.engines:
+      if engine != params.engine:
+        variants.append((dict(base, engine=engine), 1.0))
+    for scale in Config.repairClockScales:
+      variants.append((base, scale))
+    return variants
+
+  def variantText(self, options, scale):
+    args = [AutoTuner.optionText(options)]
+    if options['engine'] != 'crossings':
+      args.append('-e ' + options['engine'])
+    if scale != 1.0:
+      args.append(f'-f {self.decoder.framesPerBit*scale:.2f}')
+    return ' '.join(a for a in args if a != '') or '(none)'
+
+  # Decodes the bytes first..end-1 of the tape with the options.  Returns the
+  # bytes and their start positions
+  def _decodeSpan(self, first, end, options, scale):
+    decoder   = self.decoder
+    params    = AutoTuner.candidateParams(self.params, options)
+    positions = decoder.startPositions
+    frames    = decoder.wavFile.frames
+    framesPerBit = decoder.framesPerBit*scale
+    context = round(self.contextBytes*params.bitsPerByte*framesPerBit)
+    lo = max(0, positions[first] - context)
+    hi = min(len(frames), (positions[end] if end < len(positions) else len(frames)) + context)
+    span = frames[lo:hi]
+    if params.noiseWindow != None:
+      span = FrameFilter(params.noiseFilter, params.noiseWindow, decoder.wavFile.frameRate).apply(span)
+    if params.offsetAdjust:
+      span = FrameFilter('offset', round(framesPerBit) | 1, decoder.wavFile.frameRate).apply(span)
+    segment = SegmentDecoder(span, lo, framesPerBit, params)
+    starts, _, bitValues = segment.decode(max(0, positions[first] - lo - round(framesPerBit/2)))
+    byteValues = bytes(segment._toByte(bits) if bits >= 0 else 0 for bits in bitValues)
+    return byteValues, starts
+
+  # The block in byteValues that can replace block.  Its header must match,
+  # or if the header is damaged, it must be where the block starts
+  def _findBlock(self, byteValues, block):
+    for found, headerOk, dataOk in nascas.BlockScanner().feed(byteValues):
+      if not (headerOk and dataOk):
+        continue
+      if block.headerOk and (found.startAddress, found.length, found.count) != \
+         (block.startAddress, block.length, block.count):
+        continue
+      if not block.headerOk and found.offset > 2*self.contextBytes:
+        continue
+      return found
+    return None
+
+  # Flips the weakest bits of the data and checksum bytes of the block until
+  # the data checksum matches.  Returns the repaired bytes of the block, or
+  # None
+  def _flipBits(self, block, end):
+    decoder = self.decoder
+    if not block.headerOk or end != block.dataOffset + block.length + 1:
+      return None
+    if any(block.offset <= byteNum < end for byteNum in self.framingErrors):
+      return None
+    positions = decoder.startPositions
+    rows = decoder._confidenceRows(positions[block.dataOffset:end], positions[block.dataOffset+1:end+1],
+                                   decoder.allBytes[block.dataOffset:end])
+    dataBits = self.params.dataBits
+    weakest  = [(block.dataOffset - block.offset + bi//dataBits, bi % dataBits)
+                for bi in np.argsort(rows[:, 1:1+dataBits].ravel(), kind='stable')[:self.flipBits]]
+    flips = [[b] for b in weakest] + [list(p) for p in itertools.combinations(weakest, 2)]
+    raw = decoder.allBytes[block.offset:end]
+    dataStart = block.dataOffset - block.offset
+    for flip in flips:
+      trial = bytearray(raw)
+      for byteIndex, bit in flip:
+        trial[byteIndex] ^= 1 << bit
+      if sum(trial[dataStart:-1]) & 0xff == trial[-1]:
+        return bytes(trial), ', '.join(f'{block.offset + bi}.{bit}' for bi, bit in flip)
+    return None
+
+  # Repairs the damaged blocks, the last first, so the offsets of the blocks
+  # before it stay valid.  Returns the number of repaired and damaged blocks
+  def repair(self):
+    decoder = self.decoder
+    tape    = nascas.CasTape(decoder.allBytes)
+    damaged = [bi for bi, block in enumerate(tape.blocks) if not (block.headerOk and block.dataOk)]
+    self.framingErrors = set(byteNum for byteNum, _, _ in decoder.stats.framingErrors)
+    repaired = 0
+    for bi in reversed(damaged):
+      block = tape.blocks[bi]
+      end = block.dataOffset + block.length + 1
+      nextOffset = tape.blocks[bi+1].offset if bi + 1 < len(tape.blocks) else len(decoder.allBytes)
+      name = f'Block {block.count:02X} ({block.startAddress:04X}-{block.endAddress - 1:04X})'
+      first = max(0, block.offset - self.contextBytes)
+      spanEnd = min(len(decoder.startPositions) - 1,
+                    max(end, block.dataOffset + 256 + 1) + 2*self.contextBytes)
+      fix = None
+      for options, scale in self.variants():
+        byteValues, starts = self._decodeSpan(first, spanEnd, options, scale)
+        found = self._findBlock(byteValues, block)
+        if found != None:
+          fix = (found.raw, starts[found.offset:found.offset + len(found.raw)],
+                 'decoded with ' + self.variantText(options, scale))
+          name = f'Block {found.count:02X} ({found.startAddress:04X}-{found.startAddress + found.length - 1:04X})'
+          break
+      if fix == None:
+        flipped = self._flipBits(block, min(end, nextOffset))
+        if flipped != None:
+          raw, bits = flipped
+          fix = (raw, decoder.startPositions[block.offset:end], 'flipped bits ' + bits)
+      if fix == None:
+        self.log.info(f'{name}: checksum error, not repaired')
+        continue
+      raw, starts, how = fix
+      # the bytes of a block with a damaged length are replaced up to the
+      # next block
+      end = min(nextOffset, block.offset + max(end - block.offset, len(raw)))
+      decoder.allBytes[block.offset:end] = raw
+      decoder.startPositions[block.offset:end] = starts
+      repaired += 1
+      self.log.info(f'{name}: repaired, {how}')
+    decoder.numBytes = len(decoder.allBytes)
+    if repaired > 0:
+      # the bit periods of the bytes no longer line up with the start bits
+      decoder.periods = None
+    return repaired, len(damaged)
+
+# Reads a wav file in chunks of a fixed number of frames.  The chunks are
+# views of the memory-mapped file
+class WavStream:
+  def __init__(self, filename, params):
+    self.chunkFrames = params.chunkFrames
+    self.flushBytes  = params.chunkFrames  # decoded bytes passed on at a time
+    try:
+      with open(filename, 'rb') as file:
+        self.header = WavHeader(file)
+        self.data   = _mapData(file, self.header)
+      self.frameRate = self.header.frameRate
+      self.converter = FrameConverter(self.header, params.channel)
+      probeFrames    = min(round(Config.channelProbe*self.frameRate), self.header.nFrames)
+      self.converter.probe(self.data[0:probeFrames*self.header.blockAlign])
+      self.channel   = self.converter.channel
+      self.channels  = self.header.channels
+    except WavError as waveError:
+      Log.fatal("Cannot parse input file: " + filename + " (" + waveError.args[0] + ")")
+    except OSError as notFound:
+      Log.fatal(notFound.args[1] + ": " + filename)
+
+  def chunks(self):
+    chunkSize = self.chunkFrames*self.header.blockAlign
+    for pos in range(0, len(self.data), chunkSize):
+      yield self.converter.convert(self.data[pos:pos + chunkSize])
+
+# Decodes a wav file one chunk at a time.  Only a window of frames, reaching
+# back to the start bit of the byte being decoded, is kept in memory.
+# The stages are chained generators and the decoded bytes are identical to
+# the ones produced by WavData.process
+class StreamDecoder(WavData):
+  def __init__(self, wavStream, params):
+    self.params         = params
+    self.log            = Log(params)
+    self.wavFile        = wavStream
+    self.startPositions = None
+    self.framesPerBit   = None
+    self.frames         = bytearray()
+    self.decodedBytes   = None
+    self._crossings     = None
+    self.stats          = DecodeStats()
+    self.base           = 0    # frame number of self.frames[0]
+    self.eof            = False
+    self.numStartBits   = 0
+    self.firstStartBit  = None
+    self.lastStartBit   = None
+    self.numBytes       = 0
+    self.byteStarts     = None  # start bits of the bytes from byteStartsBase, when splitting
+    self.byteStartsBase = 0
+    self.pendingBytes   = None  # (start, end, value) of the bytes without confidences yet
+    if params.confidenceFile != None:
+      self.pendingBytes     = []
+      self.confidenceRows   = []
+      self.confidenceStarts = []
+      self.confidenceValues = bytearray()
+
+  def _byteTime(self, byteNum):
+    return self._timeStampOf(self.byteStarts[byteNum - self.byteStartsBase])
+
+  def _dropByteTimes(self, byteNum):
+    del self.byteStarts[:byteNum - self.byteStartsBase]
+    self.byteStartsBase = byteNum
+
+  def _splitter(self):
+    splitter = super()._splitter()
+    if splitter != None:
+      self.byteStarts = []
+    return splitter
+
+  # Streaming version of FrameFilter.apply.  A frame is filtered once the
+  # frames in the window after it have arrived
+  @staticmethod
+  def _slidingWindow(chunks, frameFilter):
+    half     = frameFilter.half
+    buf      = np.zeros(0, dtype=np.uint8)  # input frames from nextOut - half and onwards
+    bufStart = 0
+    nextOut  = 0
+    for chunk in chunks:
+      buf    = np.concatenate((buf, np.frombuffer(chunk, dtype=np.uint8)))
+      outEnd = bufStart + len(buf) - half - 1
+      if outEnd <= nextOut:
+        continue
+      out = buf[nextOut-bufStart:outEnd-bufStart].copy()
+      lo  = max(nextOut, half)
+      if outEnd > lo:
+        out[lo-nextOut:] = frameFilter.filterRange(buf, lo - bufStart, outEnd - bufStart)
+      nextOut = outEnd
+      drop = max(0, nextOut - half - bufStart)
+      buf = buf[drop:]
+      bufStart += drop
+      yield out.tobytes()
+    yield buf[nextOut - bufStart:].tobytes()
+
+  def _reduceNoiseStream(self, chunks):
+    noiseFilter = FrameFilter(self.params.noiseFilter, self.params.noiseWindow, self.wavFile.frameRate)
+    return self._slidingWindow(chunks, noiseFilter)
+
+  def _adjustOffsetStream(self, chunks):
+    offsetWindow = round(self.framesPerBit) | 1
+    offsetFilter = FrameFilter('offset', offsetWindow, self.wavFile.frameRate)
+    return self._slidingWindow(chunks, offsetFilter)
+
+  # Buffers the leading chunks until framesPerBit can be determined.
+  # Returns the buffered chunks, so they can be decoded afterwards
+  def _framesPerBitHead(self, chunks):
+    head = []
+    headFrames = 0
+    countAt    = 0
+    for chunk in chunks:
+      head.append(chunk)
+      headFrames += len(chunk)
+      # counting again only after the head has grown by a quarter keeps
+      # this linear, also with the small chunks of live decoding
+      if headFrames < countAt:
+        continue
+      countAt = headFrames + headFrames//4
+      self._setFrames(b''.join(head))
+      sampleCount, _, _ = self._countHalfBits()
+      if sampleCount >= Config.maxSampleCount:
+        break
+    self._setFrames(b''.join(head))
+    result = self._getFramesPerBit()
+    self._setFrames(bytearray())
+    return result, head
+
+  # Computes the confidences of the bytes decoded since the last call, while
+  # their frames are still there
+  def _flushConfidence(self):
+    if self.pendingBytes == None or len(self.pendingBytes) == 0:
+      return
+    starts, ends, byteValues = zip(*self.pendingBytes)
+    self.confidenceRows.append(self._confidenceRows(np.array(starts) - self.base,
+                                                    np.array(ends) - self.base, byteValues))
+    self.confidenceStarts.extend(starts)
+    self.confidenceValues.extend(byteValues)
+    self.pendingBytes = []
+
+  def confidences(self):
+    rows = np.concatenate(self.confidenceRows + [np.zeros((0, self.params.bitsPerByte), dtype=np.uint8)])
+    return rows, np.array(self.confidenceStarts)/self.wavFile.frameRate
+
+  def writeConfidence(self, filename):
+    self._writeConfidence(filename, self.confidenceValues, *self.confidences())
+
+  # Drops the frames before keepFrom, and appends the next chunk
+  def _extend(self, keepFrom):
+    self._flushConfidence()
+    del self.frames[:keepFrom - self.base]
+    self.base = keepFrom
+    chunk = next(self.chunkIter, None)
+    if chunk == None:
+      self.eof = True
+    else:
+      self.frames.extend(chunk)
+    self._setFrames(self.frames)
+
+  # Streaming version of _findNextZeroBit.  Positions are frame numbers.  The
+  # frames from lastStart are kept for decoding the pending byte, unless the
+  # byte has become too long to be decoded anyway
+  def _findNextStartBit(self, startFrame, lastStart):
+    while True:
+      if startFrame - self.base < len(self.frames) or self.eof:
+        found = self._findNextZeroBit(startFrame - self.base, self.framesPerBit)
+        if found != None:
+          return found + self.base
+        if self.eof:
+          return None
+        # crossings before the last three have been checked; resume from there
+        crossings = self.crossings
+        if crossings.indexAfter(startFrame - self.base) < len(crossings) - 3:
+          startFrame = int(crossings.positions[-3]) + self.base
+      keepFrom = startFrame
+      if (lastStart != None and
+          self._getNumBitsInByte(startFrame + 1 - lastStart) <= Config.maxBitsPerByte):
+        keepFrom = lastStart
+      self._extend(keepFrom)
+
+  def _decodeBytes(self, chunks):
+    self.chunkIter = iter(chunks)
+    byteValues = bytearray()
+    byteStarts = self.byteStarts
+    spi = 0
+    lastStart = self._findNextStartBit(0, None)
+    self.firstStartBit = lastStart
+    while lastStart != None:
+      self.numStartBits += 1
+      self.lastStartBit = lastStart
+      nextPos = round(lastStart + (1 + self.params.dataBits + 0.5)*self.framesPerBit)
+      nextStart = self._findNextStartBit(nextPos, lastStart)
+      if nextStart == None:
+        break
+      byteValue = self._checkByte(spi, lastStart,
+                                  *self._decodeByte(lastStart - self.base, nextStart - self.base))
+      byteValues.append(byteValue)
+      if self.pendingBytes != None:
+        self.pendingBytes.append((lastStart, nextStart, byteValue))
+      if byteStarts != None:
+        byteStarts.append(lastStart)
+      spi += 1
+      if len(byteValues) >= self.wavFile.flushBytes:
+        yield bytes(byteValues)
+        byteValues = bytearray()
+      lastStart = nextStart
+    self._flushConfidence()
+    yield bytes(byteValues)
+
+  # Generator of decoded byte chunks.  The stages run interleaved, so the
+  # stats only time the buffering of the leading chunks (framesPerBit) and the
+  # rest of the decoding (streamDecode), excluding the time spent by the
+  # consumer of the chunks
+  def process(self):
+    stats = self.stats
+    self._logChannel()
+    chunks = self.wavFile.chunks()
+    if self.params.noiseWindow != None:
+      self.log.progress('Reducing noise')
+      chunks = self._reduceNoiseStream(chunks)
+    self.log.progress('Determining frames per bit')
+    with stats.stage('framesPerBit'):
+      (framesPerBit, sampleCount, sampleTime), head = self._framesPerBitHead(chunks)
+    self.framesPerBit = framesPerBit
+    self.log.info(f'Frames per bit after {sampleCount} samples: {framesPerBit:.4f}. ' +
+            f'Last sample at: {sampleTime:.5f}s. ' +
+            f'Real baud rate: {int(self.wavFile.frameRate/framesPerBit)}.')
+    chunks = itertools.chain(head, chunks)
+    if self.params.offsetAdjust:
+      self.log.progress('Offsetting frames')
+      chunks = self._adjustOffsetStream(chunks)
+    self.log.progress('Finding start bits and converting bits to bytes')
+    start = time.perf_counter()
+    for byteValues in self._decodeBytes(chunks):
+      stats.addStage('streamDecode', time.perf_counter() - start)
+      self.numBytes += len(byteValues)
+      yield byteValues
+      start = time.perf_counter()
+    self.log.info(f'Found {self.numStartBits} start bits, ' +
+             f'First: {self._timeStampOf(self.firstStartBit):.5f}s, ' +
+             f'Last: {self._timeStampOf(self.lastStartBit):.5f}s')
+    self.log.info(f'Number of bytes: {self.numBytes}')
+    frames = self.wavFile.header.nFrames
+    stats.setCounter('frames', frames)
+    stats.setCounter('audioSeconds', self._timeStampOf(frames))
+    stats.setCounter('framesPerBit', framesPerBit)
+    stats.setCounter('framesPerBitSamples', sampleCount)
+    stats.setCounter('startBits', self.numStartBits)
+    stats.setCounter('bytes', self.numBytes)
+
+  def writeToFile(self, filename):
+    try:
+      casFile = open(filename, "wb")
+    except:
+      Log.fatal("Cannot write to output file: " + filename)
+    else:
+      splitter = self._splitter()
+      for byteValues in self.process():
+        casFile.write(byteValues)
+        if splitter != None:
+          splitter.feed(byteValues)
+      casFile.close()
+      if splitter != None:
+        splitter.close()
+
+# Reads frames from a pipe, a FIFO or standard in as they arrive, with an
+# asyncio stream reader.  Regular files are read in a worker thread instead.
+# asyncio is only imported for live decoding, as it adds to the startup time
+# of every conversion.
+# The input is a .wav stream, whose data size is ignored, or raw unsigned 8
+# bit mono frames.  The frames are converted and put in a queue, from which
+# the decoder thread takes them in chunks of at most chunkFrames frames.
+# A chunk is queued as soon as some frames have arrived, so the decoding
+# keeps up with the input
+class LiveWavStream:
+  def __init__(self, filename, params):
+    self.filename    = filename
+    self.chunkFrames = params.chunkFrames if params.chunkFrames != None else Config.liveChunkFrames
+    self.flushBytes  = 1
+    self.rawRate     = params.liveRate
+    self.channelParam = params.channel
+    self.queue       = queue.Queue()
+    self.file        = None
+    self.loop        = None
+    self.reader      = None
+    self.pending     = b''  # frames read but not queued
+
+  async def _read(self, n):
+    if self.reader != None:
+      return await self.reader.read(n)
+    return await self.loop.run_in_executor(None, self.file.read, n)
+
+  async def _readExactly(self, n):
+    data = b''
+    while len(data) < n:
+      more = await self._read(n - len(data))
+      if len(more) == 0:
+        raise WavError('incomplete header')
+      data += more
+    return data
+
+  # The header of a .wav stream, or of raw 8 bit mono frames
+  async def _readHeader(self):
+    riff = await self._readExactly(4)
+    if riff != b'RIFF':
+      self.pending = riff
+      return WavHeader.fromFormat(struct.pack('<HHIIHH', WavHeader.formatPcm, 1,
+                                              self.rawRate, self.rawRate, 1, 8))
+    if (await self._readExactly(8))[4:8] != b'WAVE':
+      raise WavError('not a RIFF/WAVE file')
+    header = None
+    while True:
+      chunkId, chunkSize = struct.unpack('<4sI', await self._readExactly(8))
+      if chunkId == b'data':
+        if header == None:
+          raise WavError('data chunk before fmt chunk')
+        return header
+      chunk = await self._readExactly(chunkSize + (chunkSize & 1))
+      if chunkId == b'fmt ':
+        header = WavHeader.fromFormat(chunk[0:chunkSize])
+
+  # Connects the reader and reads the header.  The channel is picked from
+  # the first Config.liveProbe seconds
+  async def open(self):
+    import asyncio
+    self.loop = asyncio.get_running_loop()
+    self.file = sys.stdin.buffer if self.filename == '-' else open(self.filename, 'rb')
+    reader = asyncio.StreamReader()
+    try:
+      await self.loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), self.file)
+      self.reader = reader
+    except (ValueError, NotImplementedError):
+      pass  # a regular file
+    self.header    = await self._readHeader()
+    self.frameRate = self.header.frameRate
+    self.converter = FrameConverter(self.header, self.channelParam)
+    if self.converter.channel == None:
+      probeSize = round(Config.liveProbe*self.frameRate)*self.header.blockAlign
+      while len(self.pending) < probeSize:
+        more = await self._read(probeSize - len(self.pending))
+        if len(more) == 0:
+          break
+        self.pending += more
+      self.converter.probe(self.pending)
+    self.channel  = self.converter.channel
+    self.channels = self.header.channels
+
+  # Queues the frames until the end of the input.  header.nFrames is the
+  # number of frames queued
+  async def read(self):
+    blockAlign = self.header.blockAlign
+    try:
+      while True:
+        nBytes = len(self.pending) - len(self.pending) % blockAlign
+        if nBytes > 0:
+          self.queue.put(self.converter.convert(self.pending[0:nBytes]))
+          self.header.nFrames += nBytes//blockAlign
+          self.pending = self.pending[nBytes:]
+        more = await self._read(self.chunkFrames*blockAlign)
+        if len(more) == 0:
+          break
+        self.pending += more
+    finally:
+      self.queue.put(None)
+
+  def chunks(self):
+    return iter(self.queue.get, None)
+
+# Decodes a live stream.  The decoded bytes are written to the output file as
+# they are decoded, and the NAS-SYS blocks are reported as soon as they are
+# complete, with their checksum status and how far the decoding is behind
+# the input
+class LiveDecoder(StreamDecoder):
+  def _reportBlock(self, block, headerOk, dataOk):
+    endFrame = self.lastStartBit + self.params.bitsPerByte*self.framesPerBit
+    lag      = self._timeStampOf(max(0, self.wavFile.header.nFrames - endFrame))
+    text = (f'Block {block.count:02X} ({block.startAddress:04X}-{block.startAddress + block.length - 1:04X}) ' +
+            f'at {self._timeStampOf(endFrame):.3f}s')
+    if not headerOk:
+      self.log.error(text + ': header checksum error')
+    elif not dataOk:
+      self.log.error(text + f': checksum error. {block.dataChecksum():02X} != {block.checksum:02X}')
+    else:
+      self.log.info(text + f': ok, {lag:.3f}s behind the input')
+    sys.stdout.flush()
+    return lag
+
+  def writeToFile(self, filename):
+    try:
+      casFile = open(filename, "wb")
+    except:
+      Log.fatal("Cannot write to output file: " + filename)
+    scanner  = nascas.BlockScanner()
+    splitter = self._splitter()
+    blocks    = 0
+    badBlocks = 0
+    maxLag    = 0.0
+    for byteValues in self.process():
+      casFile.write(byteValues)
+      casFile.flush()
+      if splitter != None:
+        splitter.feed(byteValues)
+      for block, headerOk, dataOk in scanner.feed(byteValues):
+        maxLag = max(maxLag, self._reportBlock(block, headerOk, dataOk))
+        blocks += 1
+        if not (headerOk and dataOk):
+          badBlocks += 1
+    casFile.close()
+    if splitter != None:
+      splitter.close()
+    self.log.info(f'Blocks: {blocks}, with checksum errors: {badBlocks}')
+    self.stats.setCounter('blocks', blocks)
+    self.stats.setCounter('badBlocks', badBlocks)
+    self.stats.setCounter('maxLag', maxLag)
+
+# Decodes the live input given by params.  The input is read by the event
+# loop, while the frames are decoded in a worker thread.  Returns the decoder
+async def _decodeLive(params):
+  stream = LiveWavStream(params.inputFilename, params)
+  try:
+    await stream.open()
+  except WavError as waveError:
+    Log.fatal("Cannot parse input: " + params.inputFilename + " (" + waveError.args[0] + ")")
+  except OSError as notFound:
+    Log.fatal(notFound.args[1] + ": " + params.inputFilename)
+  decoder = LiveDecoder(stream, params)
+  decoder.log.progress("Decoding live input to output file: " + params.outputFilename)
+  reading = stream.loop.create_task(stream.read())
+  await stream.loop.run_in_executor(None, decoder.writeToFile, params.outputFilename)
+  await reading
+  return decoder
+
+def decodeLive(params):
+  import asyncio
+  return asyncio.run(_decodeLive(params))
+
+# A wav file restored from the decoding cache.  Has the WavFile attributes
+# used by WavData; the frames are the filtered frames
+class CachedWavFile:
+  def __init__(self, frames, frameRate, channel, channels):
+    self.frames    = frames
+    self.frameRate = frameRate
+    self.channel   = channel
+    self.channels  = channels
+
+# On-disk cache of decodings, keyed by the SHA-256 of the wav file and the
+# options affecting the decoding.  An entry is a directory with the filtered
+# frames (frames.u8), the zero crossings, start positions and the bit
+# periods of the clock recovery (.npy), the decoded bytes (output.cas) and
+# meta.json.  The frames are memory-mapped
+# when loaded.  Loading an entry touches its meta.json, and the entries
+# with the oldest meta.json are evicted when the cache grows beyond maxSize
+class DecodeCache:
+  version   = 2
+  keyParams = ['channel', 'noiseWindow', 'noiseFilter', 'offsetAdjust', 'framesPerBit',
+               'dataBits', 'stopBits', 'engine', 'clock', 'autoTune', 'repairBlocks']
+  arrays    = ['positions', 'directions', 'peaks', 'startPositions', 'periods']
+
+  def __init__(self, directory, maxSize = None):
+    self.directory = directory
+    self.maxSize   = Config.cacheSize if maxSize == None else maxSize
+
+  @staticmethod
+  def fileHash(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+      for block in iter(lambda: file.read(1 << 20), b''):
+        digest.update(block)
+    return digest.hexdigest()
+
+  def key(self, filename, params):
+    options = {name: getattr(params, name) for name in self.keyParams}
+    text = json.dumps({'version': self.version, 'wav': self.fileHash(filename), 'options': options},
+                      sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+  @staticmethod
+  def _mapFile(filename):
+    with open(filename, 'rb') as file:
+      return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+  # Restores the decoder stored for key, or returns None if there is none.
+  # The options picked by auto tuning are restored as well
+  def load(self, key, params):
+    entryDir = os.path.join(self.directory, key)
+    try:
+      with open(os.path.join(entryDir, 'meta.json')) as metaFile:
+        meta = json.load(metaFile)
+      frames = memoryview(self._mapFile(os.path.join(entryDir, 'frames.u8')))
+      arrays = {name: np.load(os.path.join(entryDir, name + '.npy'), mmap_mode='r') for name in self.arrays}
+      with open(os.path.join(entryDir, 'output.cas'), 'rb') as casFile:
+        allBytes = casFile.read()
+      os.utime(os.path.join(entryDir, 'meta.json'))
+    except (OSError, ValueError):
+      return None
+    params = copy.copy(params)
+    for name, value in meta['params'].items():
+      setattr(params, name, value)
+    params.bitsPerByte = 1 + params.dataBits + params.stopBits
+    decoder = WavData(CachedWavFile(frames, meta['frameRate'], meta['channel'], meta['channels']), params)
+    decoder._crossings     = ZeroCrossings.fromArrays(frames, arrays['positions'],
+                                                      arrays['directions'], arrays['peaks'])
+    decoder.startPositions = arrays['startPositions'].tolist()
+    decoder.framesPerBit   = meta['framesPerBit']
+    decoder.periods        = arrays['periods'].tolist() if meta['periods'] else None
+    decoder.allBytes       = allBytes
+    decoder.numBytes       = len(allBytes)
+    decoder.tunedOptions   = meta['tunedOptions']
+    decoder.stats.counters.update(meta['counters'])
+    decoder.stats.framingErrors = [tuple(e) for e in meta['framingErrors']]
+    for msg in meta['errors']:
+      decoder.log.error(msg)
+    return decoder
+
+  # Stores a decoder that has processed its frames.  The entry is written to
+  # a temporary directory and renamed, so a concurrent load never sees a
+  # partial entry
+  def store(self, key, decoder):
+    entryDir = os.path.join(self.directory, key)
+    try:
+      os.makedirs(self.directory, exist_ok=True)
+      tempDir = tempfile.mkdtemp(prefix=key[:16] + '.', suffix='.tmp', dir=self.directory)
+    except OSError:
+      decoder.log.info("Cannot write to cache directory: " + self.directory)
+      return
+    try:
+      with open(os.path.join(tempDir, 'frames.u8'), 'wb') as framesFile:
+        framesFile.write(decoder.frames)
+      positions, directions, peaks = decoder.crossings.toArrays()
+      arrays = {'positions': positions, 'directions': directions, 'peaks': peaks,
+                'startPositions': np.array(decoder.startPositions, dtype=positions.dtype),
+                'periods': np.array(decoder.periods or [], dtype=np.float64)}
+      for name in self.arrays:
+        np.save(os.path.join(tempDir, name + '.npy'), arrays[name])
+      with open(os.path.join(tempDir, 'output.cas'), 'wb') as casFile:
+        casFile.write(decoder.allBytes)
+      meta = {
+        'frameRate':     decoder.wavFile.frameRate,
+        'channel':       decoder.wavFile.channel,
+        'channels':      decoder.wavFile.channels,
+        'framesPerBit':  decoder.framesPerBit,
+        'periods':       decoder.periods != None,
+        'params':        {name: getattr(decoder.params, name) for name in self.keyParams if name != 'autoTune'},
+        'tunedOptions':  decoder.tunedOptions,
+        'counters':      decoder.stats.counters,
+        'framingErrors': decoder.stats.framingErrors,
+        'errors':        decoder.log.errors,
+      }
+      with open(os.path.join(tempDir, 'meta.json'), 'w') as metaFile:
+        json.dump(meta, metaFile)
+      os.rename(tempDir, entryDir)
+    except OSError:
+      # stored by another process in the meantime, or out of disk space
+      shutil.rmtree(tempDir, ignore_errors=True)
+    self._evict(key)
+
+  # Removes the least recently used entries, but not keep, until the cache
+  # is within maxSize
+  def _evict(self, keep):
+    entries = []
+    total = 0
+    for name in os.listdir(self.directory):
+      entryDir = os.path.join(self.directory, name)
+      try:
+        used = os.path.getmtime(os.path.join(entryDir, 'meta.json'))
+        size = sum(os.path.getsize(os.path.join(entryDir, f)) for f in os.listdir(entryDir))
+      except OSError:
+        continue  # not an entry, or removed by another process
+      entries.append((used, name, size))
+      total += size
+    for used, name, size in sorted(entries):
+      if total <= self.maxSize:
+        break
+      if name != keep:
+        shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        total -= size
+
+# Decodes a wav file, auto tuning the params first if requested.  Returns
+# the decoder
+def _decode(wavFile, params, readTime):
+  tunedOptions = None
+  if params.autoTune:
+    start = time.perf_counter()
+    tuner = AutoTuner(wavFile, params)
+    params = tuner.tune()
+    tunedOptions = tuner.optionText(tuner.results[0]['options'])
+    tuneTime = time.perf_counter() - start
+  decoder = WavData(wavFile, params)
+  decoder.tunedOptions = tunedOptions
+  decoder.stats.addStage('read', readTime)
+  if tunedOptions != None:
+    decoder.stats.addStage('autoTune', tuneTime)
+  decoder.process()
+  if params.repairBlocks:
+    decoder.log.progress('Repairing blocks with checksum errors')
+    with decoder.stats.stage('repair'):
+      repaired, damaged = BlockRepairer(decoder).repair()
+    decoder.log.info(f'Repaired {repaired} of {damaged} blocks with checksum errors')
+    decoder.stats.setCounter('repairedBlocks', repaired)
+    decoder.stats.setCounter('damagedBlocks', damaged)
+  return decoder
+
+# The result of decodeWav.  data is the decoded .cas content, errors the
+# framing errors reported while decoding, and stats the DecodeStats
+class DecodeResult:
+  def __init__(self, decoder):
+    self.data         = bytes(decoder.allBytes)
+    self.errors       = decoder.log.errors
+    self.framesPerBit = decoder.framesPerBit
+    self.tunedOptions = decoder.tunedOptions
+    self.stats        = decoder.stats
+    self._decoder     = decoder
+
+  # The confidences of the bits of the bytes in data, 0 to 255, as an array
+  # with a row per byte, and the times of their start bits.  Computed when
+  # asked for; see WavData.confidences
+  def confidences(self):
+    return self._decoder.confidences()
+
+# Library API: decodes a .wav file in-process, without any output.  source is
+# a file name, a binary file object or a buffer with the content of a .wav
+# file.  options are decoding options by their Params names, e.g.
+# {'noiseWindow': 3, 'offsetAdjust': True}; see Params.optionChecks.
+# Raises DecodeError if the source can't be decoded, and ValueError for
+# illegal options.  No state is shared between calls, so it can be called
+# from several threads at once
+def decodeWav(source, options = None):
+  params = Params.fromOptions(options)
+  start = time.perf_counter()
+  wavFile = WavFile.fromSource(source, params)
+  return DecodeResult(_decode(wavFile, params, time.perf_counter() - start))
+
+# Converts params.inputFilename to params.outputFilename.  Returns the decoder
+def convert(params):
+  if params.liveRate != None:
+    decoder = decodeLive(params)
+  elif params.chunkFrames != None:
+    decoder = StreamDecoder(WavStream(params.inputFilename, params), params)
+    decoder.log.progress("Streaming to output file: " + params.outputFilename)
+    decoder.writeToFile(params.outputFilename)
+  else:
+    cache   = None
+    decoder = None
+    if params.cacheDir != None:
+      start = time.perf_counter()
+      cache = DecodeCache(params.cacheDir)
+      try:
+        key = cache.key(params.inputFilename, params)
+      except OSError as notFound:
+        Log.fatal(notFound.args[1] + ": " + params.inputFilename)
+      decoder = cache.load(key, params)
+      if decoder != None:
+        decoder.log.info(f'Using cached decoding: {key[:16]}')
+        decoder.log.info(f'Number of bytes: {decoder.numBytes}')
+        decoder.stats.addStage('cacheLoad', time.perf_counter() - start)
+        decoder.stats.setCounter('cached', 1)
+    if decoder == None:
+      start = time.perf_counter()
+      wf = WavFile(params.inputFilename, params)
+      decoder = _decode(wf, params, time.perf_counter() - start)
+      if cache != None:
+        decoder.stats.setCounter('cached', 0)
+        with decoder.stats.stage('cacheStore'):
+          cache.store(key, decoder)
+    decoder.log.progress("Writing to output file: " + params.outputFilename)
+    with decoder.stats.stage('write'):
+      decoder.writeToFile(params.outputFilename)
+  if params.confidenceFile != None:
+    decoder.log.progress("Writing confidences to: " + params.confidenceFile)
+    with decoder.stats.stage('confidence'):
+      decoder.writeConfidence(params.confidenceFile)
+  if params.metricsFile != None:
+    decoder.stats.write(params.metricsFile, {'file': os.path.basename(params.inputFilename)})
+  return decoder
 
 def main():
-  Params.parse()
-  wf = WavFile(Params.inputFilename)
-  wd = WavData(wf)
-  wd.process()
-  Log.progress("Writing to output file: " + Params.outputFilename)
-  wd.writeToFile(Params.outputFilename)
-  if Params.plot != None:
-    wd.plotByte(Params.plot)
+  params = Params().parse()
+  try:
+    wd = convert(params)
+    if params.plot != None:
+      wd.plotByte(params.plot)
+  except DecodeError as decodeError:
+    print("ERROR: " + decodeError.args[0])
+    sys.exit(1)
   return
 
 if __name__ == '__main__':
@@ -0,0 +1,14 @@
+# Author: Peter Jensen
+#
+# Plotting of wav data.  Kept separate from wavcas.py, so matplotlib is only
+# imported when a plot is requested (-p)
+#
+import matplotlib.pyplot as plt
+
+def plotByteFrames(frames, bitPositions):
+  fig, ax = plt.subplots(1, 1, figsize=(10,5))
+  plt.grid(visible=True, which='both', axis='both')
+  intFrames = [int(v)-0x80 for v in frames]
+  ax.set_xticks(bitPositions)
+  plt.plot(intFrames)
+  plt.show()